@@ -9,6 +9,7 @@ import datetime
 import io
 import json
 import os
+import posixpath
 import threading
 import time
 import logging
@@ -20,10 +21,29 @@ from requests_toolbelt import MultipartEncoder
 import sentry_sdk
 
 import octoprint.plugin
+from octoprint.util.net import is_lan_address
+from octoprint.server.util.flask import get_remote_address
 from octoprint.filemanager import FileDestinations
 from octoprint.filemanager.util import StreamWrapper, DiskFileWrapper
 
-from .ws import Socket
+from .ws import Socket, Inbox
+from .gateway import Gateway, GatewayClient, GatewaySocket
+from .telemetry import RateController, Topic
+from .link import LinkMonitor
+from .vibration import VibrationMonitor, make_source
+from .status import StatusPublisher
+from .events import EventBatcher, FILE_EVENTS
+from .anomaly import AnomalyMonitor
+from .timelapse import TimelapseArchiver
+from .commands import CommandCoalescer
+from .batch import BatchRunner, plan, validate, QUIET_PERIOD
+from .config import Config, affected
+from .trace import CommandTracer, tags as trace_tags
+from .sync import SyncEngine
+from .prefetch import Prefetcher
+from .shaper import TrafficShaper, ShapedReader, shaped_content, CONTROL, SNAPSHOT
+from .agent import AgentProcess, AgentShaper, AgentSocket
+from .framecache import FrameCache
 from .printer import Printer
 from .backoff import BackoffTime
 
@@ -33,6 +53,7 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
                        octoprint.plugin.TemplatePlugin,
                        octoprint.plugin.AssetPlugin,
                        octoprint.plugin.SimpleApiPlugin,
+                       octoprint.plugin.BlueprintPlugin,
                        octoprint.plugin.EventHandlerPlugin):
 
     def __init__(self):
@@ -45,10 +66,46 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
         self.ws_data_count = 0
         self.loop_time = 1.0
         self.ws_loop_time = 60
+        self.gateway = None
+        self.vibration = None
+        self.anomaly = None
+        self.archive = None
+        self.sync = None
+        self.prefetch = None
+        self.agent = None
+        self.last_capture = {1: 0, 2: 0}
+        self.files_quiet_until = 0
         self.sentry = sentry_sdk.init(
             "https://878e280471064d3786d9bcd063e46ad7@sentry.io/1850943"
         )
 
+    def initialize(self):
+        self.config = self.load_config()
+        self.shaper = TrafficShaper(
+            rate=self.config.bandwidth_kbps * 125,
+            adaptive=self.config.bandwidth_adaptive)
+        # Bulk transfers made in the plugin share the agent's budget.
+        self.bulk = AgentShaper(lambda: self.agent, self.shaper)
+        self.link = LinkMonitor(dead_timeout=self.config.link_timeout)
+        self.tracer = CommandTracer(send=self.send_command_ack)
+        self.telemetry = self.make_telemetry()
+        self.events = EventBatcher(
+            window=self.config.event_window,
+            policies=dict(self.config.event_policies))
+        self.commands = CommandCoalescer(
+            execute=self.dispatch,
+            done=self.send_state,
+            window=self.config.command_window)
+        self.frames = FrameCache(ttl=self.config.frame_cache_ttl)
+        self.inbox = Inbox(handle=self.ws_on_message)
+        self.batches = BatchRunner(
+            run=self.run_batch,
+            send=self.send_batch_result,
+            connection=lambda: self.ws if self.ws_connected() else None)
+        self.status = StatusPublisher(send=self.push_status)
+        self.status.update(ws_connected=False, rtt=None, queue_depth=0,
+                           last_snapshot=None)
+
     def get_settings_defaults(self):
         return dict(
             enabled=True,
@@ -56,16 +113,173 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
             authorization_token="e.g. w1il4li2am2ca1xt4on91",
             upload_dir="/home/pi/.octoprint/uploads/",
             config_print=False,
-            ws_connected=False,
             num_cameras=1,
             camera_interval_1=3,
             camera_interval_2=10,
             snapshot_url_1='http://localhost:8080/?action=snapshot',
             snapshot_url_2='http://localhost:8081/?action=snapshot',
+            snapshot_transport="http",
+            anomaly_enabled=False,
+            anomaly_interval_min=1,
+            anomaly_interval_max=30,
+            anomaly_threshold=0.5,
+            anomaly_model="",
+            archive_enabled=False,
+            archive_max_frames=3000,
+            archive_max_mb=500,
+            archive_fps=25,
+            sync_enabled=False,
+            sync_interval=600,
+            sync_streams=3,
+            prefetch_enabled=False,
+            prefetch_lookahead=3,
+            prefetch_max_rate=512,
+            bandwidth_kbps=0,
+            bandwidth_adaptive=True,
+            agent_enabled=False,
+            frame_cache_enabled=False,
+            frame_cache_ttl=2,
+            vibration_enabled=False,
+            vibration_source="",
+            vibration_sample_rate=800,
+            vibration_window=1024,
+            vibration_bands=[[0, 10], [10, 50], [50, 100], [100, 200], [200, 400]],
             vibration_interval=10,
             temperature_interval=1,
+            temperature_deadband=0.5,
+            progress_deadband=0.1,
+            telemetry_keepalive=300,
+            event_window=0.5,
+            command_window=0.15,
+            event_policies={},
+            heartbeat_interval=2,
+            link_timeout=6,
+            printer_id="",
+            gateway_mode="off",
+            gateway_host="",
+            gateway_port=8765,
+            gateway_secret="",
         )
 
+    def load_config(self):
+        return Config.load(lambda name: self._settings.get([name]),
+                           self.get_settings_defaults())
+
+    def on_settings_save(self, data):
+        octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+        self.reload_config()
+
+    def reload_config(self):
+        # Swaps in a new settings snapshot and restarts only the subsystems
+        # whose settings changed.
+        old, self.config = self.config, self.load_config()
+        for subsystem in affected(old, self.config):
+            self._logger.info("Settings changed, restarting %s", subsystem)
+            try:
+                getattr(self, "restart_" + subsystem)()
+            except Exception as e:
+                self._logger.error("Restarting %s: %s", subsystem, e)
+
+    def restart_agent(self):
+        # The websocket is restarted after this, on the agent or in process.
+        if self.agent is not None:
+            self.agent.stop()
+            self.agent = None
+        self.start_agent()
+
+    def restart_gateway(self):
+        if self.gateway is not None:
+            self.gateway.stop()
+            self.gateway = None
+        self.start_gateway()
+
+    def restart_websocket(self):
+        # The send loop reconnects with the new settings once the current
+        # connection is gone.
+        if self.ws_available():
+            self.ws.disconnect()
+
+    def restart_camera(self, camera):
+        self.last_capture[camera] = 0
+        if self.anomaly is not None:
+            self.anomaly.camera(camera).reset()
+
+    def restart_camera_1(self):
+        self.restart_camera(1)
+
+    def restart_camera_2(self):
+        self.restart_camera(2)
+
+    def restart_telemetry(self):
+        self.configure_telemetry(self.telemetry)
+
+    def restart_events(self):
+        self.events.window = self.config.event_window
+        self.events.set_policies(dict(self.config.event_policies))
+
+    def restart_commands(self):
+        self.commands.window = self.config.command_window
+
+    def restart_shaper(self):
+        self.shaper.set_budget(self.config.bandwidth_kbps * 125,
+                               self.config.bandwidth_adaptive)
+        if self.agent is not None:
+            self.agent.configure(self.agent_options())
+
+    def restart_frames(self):
+        self.frames.ttl = self.config.frame_cache_ttl
+
+    def restart_link(self):
+        self.link.dead_timeout = self.config.link_timeout
+        if self.agent is not None:
+            self.agent.configure(self.agent_options())
+
+    def restart_vibration(self):
+        if self.vibration is not None:
+            self.vibration.stop()
+            self.vibration = None
+        if self.config.vibration_enabled:
+            self.start_vibration()
+
+    def restart_anomaly(self):
+        if self.anomaly is not None:
+            self.anomaly.stop()
+            self.anomaly = None
+        if self.config.anomaly_enabled:
+            self.start_anomaly()
+
+    def restart_archive(self):
+        # A job being archived keeps its store, new limits apply from the
+        # next job on.
+        if not self.config.archive_enabled:
+            if self.archive is not None:
+                self.archive.finish(success=False)
+                self.archive = None
+        elif self.archive is None:
+            self.start_archive()
+        else:
+            self.archive.url = self.config.timelapse_url
+            self.archive.fps = self.config.archive_fps
+            self.archive.max_frames = self.config.archive_max_frames
+            self.archive.max_bytes = self.config.archive_max_mb * 1024 * 1024
+
+    def restart_sync(self):
+        if self.sync is not None:
+            self.sync.stop()
+            self.sync = None
+        if self.config.sync_enabled:
+            self.start_sync()
+
+    def restart_prefetch(self):
+        queue = []
+        if self.prefetch is not None:
+            self.prefetch.stop()
+            queue = self.prefetch.queue()
+            self.prefetch = None
+        if self.config.prefetch_enabled:
+            self.start_prefetch()
+            self.prefetch.set_queue(queue)
+
     def get_assets(self):
         return dict(
             js=['js/mattacloud.js'],
@@ -104,69 +318,107 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
 
     # TODO: Improve URL creation
     # Should write a urljoin function
+    # The URLs are built once per settings change, see Config.load.
     def get_base_url(self):
-        if not self._settings.get(["base_url"]):
+        if not self.config.base_url:
             self._logger.warning("No base URL in OctoPrint settings")
             return None
-
-        url = self._settings.get(["base_url"])
-        url = url.strip()
-        if url.startswith("/"):
-            url = url[1:]
-        if url.endswith("/"):
-            url = url[:-1]
-        return url
+        return self.config.base_url
 
     def get_api_url(self):
-        base_url = self.get_base_url()
-        url = base_url + "/api"
-        return url
+        return self.config.api_url
 
     def get_ws_url(self):
-        api_url = self.get_api_url()
-        url = api_url + "/ws/printer/"
-        url = url.replace("http", "ws")
-        return url
+        return self.config.ws_url
 
     def get_ping_url(self):
-        api_url = self.get_api_url()
-        url = api_url + "/ping/"
-        return url
+        return self.config.ping_url
 
     def get_data_url(self):
-        api_url = self.get_api_url()
-        url = api_url + "/receive/data/"
-        return url
+        return self.config.data_url
 
     def get_img_url(self):
-        api_url = self.get_api_url()
-        url = api_url + "/receive/img/"
-        return url
+        return self.config.img_url
 
     def get_gcode_url(self):
-        api_url = self.get_api_url()
-        url = api_url + "/receive/gcode/"
-        return url
+        return self.config.gcode_url
 
     def get_request_url(self):
-        api_url = self.get_api_url()
-        url = api_url + "/receive/request/"
-        return url
+        return self.config.request_url
+
+    def get_timelapse_url(self):
+        return self.config.timelapse_url
 
     def get_auth_token(self):
-        if not self._settings.get(["authorization_token"]):
+        if not self.config.authorization_token:
             return None
-        return self._settings.get(["authorization_token"])
+        return self.config.authorization_token
 
     def make_auth_header(self, token=None):
         if not token:
             token = self.get_auth_token()
         return {"Authorization": "Token {}".format(token)}
 
+    def get_printer_id(self):
+        return self.config.printer_id
+
+    def get_gateway_mode(self):
+        return self.config.gateway_mode
+
+    def make_telemetry(self):
+        telemetry = RateController()
+        telemetry.add(Topic("temperature_data", self.get_printer_temps))
+        telemetry.add(Topic("printer_data", self.get_printer_data,
+                            min_interval=1.0,
+                            poll_interval=0.2,
+                            ignore=("printTime", "printTimeLeft",
+                                    "printTimeLeftOrigin", "filepos"),
+                            urgent=("state",)))
+        telemetry.add(Topic("job", self.get_current_job,
+                            min_interval=1.0))
+        telemetry.add(Topic("files", self.get_files,
+                            min_interval=2.0,
+                            poll_interval=60.0))
+        telemetry.add(Topic("link", self.link_stats,
+                            min_interval=60.0))
+        telemetry.add(Topic("command_latency", self.tracer.stats,
+                            min_interval=60.0))
+        telemetry.add(Topic("bandwidth", self.bandwidth_stats,
+                            min_interval=60.0))
+        self.configure_telemetry(telemetry)
+        return telemetry
+
+    def configure_telemetry(self, telemetry):
+        # Applied in place so that the cloud's subscriptions survive a
+        # settings change.
+        with telemetry.lock:
+            telemetry.keepalive = self.config.telemetry_keepalive
+            temperature = telemetry.topics["temperature_data"]
+            temperature.min_interval = self.config.temperature_interval
+            temperature.poll_interval = self.config.temperature_interval
+            temperature.deadband = self.config.temperature_deadband
+            telemetry.topics["printer_data"].deadband = \
+                self.config.progress_deadband
+
     def on_after_startup(self):
         self._logger.info("Starting OctoPrint-Mattacloud Plugin...")
         self.new_print_job = False
         self.ws = None
+        self.status.start()
+        self.inbox.start()
+        self.batches.start()
+        self.start_agent()
+        self.start_gateway()
+        if self.config.vibration_enabled:
+            self.start_vibration()
+        if self.config.anomaly_enabled:
+            self.start_anomaly()
+        if self.config.archive_enabled:
+            self.start_archive()
+        if self.config.sync_enabled:
+            self.start_sync()
+        if self.config.prefetch_enabled:
+            self.start_prefetch()
         main_thread = threading.Thread(target=self.loop)
         main_thread.daemon = True
         main_thread.start()
@@ -175,25 +427,251 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
         ws_data_thread.daemon = True
         ws_data_thread.start()
 
-    def event_ws_data(self, event, payload):
-        data = self.ws_data()
-        data["event"] = {
-            "event_type": event,
-            "payload": payload
+    def start_agent(self):
+        # The agent takes the websocket, with its JSON encoding, heartbeats
+        # and shaping, and the snapshot and gcode uploads. The rest stays in
+        # process: capturing from the cameras, whose frames are also needed
+        # by the frame cache, the anomaly monitor and the timelapse, building
+        # the status data, and upload_request downloads, sync, prefetch and
+        # timelapse uploads, which hand their files to OctoPrint. Those only
+        # take their bandwidth from the agent's shaper, see AgentShaper.
+        if not self.config.agent_enabled:
+            return
+        if self.config.gateway_mode != "off":
+            self._logger.warning("The agent can not be used with a gateway, "
+                                 "running in process")
+            return
+        self.agent = AgentProcess(options=self.agent_options())
+        self.agent.start()
+
+    def agent_options(self):
+        return {
+            "link_timeout": self.config.link_timeout,
+            "bandwidth": self.config.bandwidth_kbps * 125,
+            "adaptive": self.config.bandwidth_adaptive,
         }
-        return data
 
-    def on_event(self, event, payload):
+    # With the agent running, the link and the shaper that matter are the
+    # agent's, which reports their stats every second.
+    def link_stats(self):
+        if self.agent is not None:
+            return self.agent.stats.get("link") or self.link.stats()
+        return self.link.stats()
+
+    def bandwidth_stats(self):
+        if self.agent is not None:
+            return self.agent.stats.get("bandwidth") or self.shaper.stats()
+        return self.shaper.stats()
+
+    def start_gateway(self):
+        if self.config.gateway_mode == "server":
+            self.gateway = Gateway(printer_id=self.config.printer_id,
+                                   port=self.config.gateway_port,
+                                   secret=self.config.gateway_secret)
+            self.gateway.start()
+
+    def start_vibration(self):
+        if not VibrationMonitor.available():
+            self._logger.warning(
+                "Vibration monitoring requires numpy, which is not installed")
+            return
+        if not self.config.vibration_source:
+            self._logger.warning("No vibration sensor source in settings")
+            return
+        sample_rate = self.config.vibration_sample_rate
+        self.vibration = VibrationMonitor(
+            source=make_source(self.config.vibration_source, sample_rate),
+            send=self.send_vibration,
+            sample_rate=sample_rate,
+            window=self.config.vibration_window,
+            interval=self.config.vibration_interval,
+            bands=self.config.vibration_bands,
+        )
+        self.vibration.start()
+
+    def start_anomaly(self):
+        if not AnomalyMonitor.available():
+            self._logger.warning(
+                "Anomaly scoring requires numpy and Pillow, which are not installed")
+            return
+        self.anomaly = AnomalyMonitor(
+            floor=self.config.anomaly_interval_min,
+            ceiling=self.config.anomaly_interval_max,
+            threshold=self.config.anomaly_threshold,
+            model_path=self.config.anomaly_model,
+        )
+        self.anomaly.start()
+
+    def start_archive(self):
+        self.archive = TimelapseArchiver(
+            root=os.path.join(self.get_plugin_data_folder(), "timelapse"),
+            url=self.get_timelapse_url(),
+            make_headers=self.make_auth_header,
+            ffmpeg=self._settings.global_get(["webcam", "ffmpeg"]),
+            fps=self.config.archive_fps,
+            max_frames=self.config.archive_max_frames,
+            max_bytes=self.config.archive_max_mb * 1024 * 1024,
+            shaper=self.bulk,
+        )
+        self.archive.resume()
+
+    def start_sync(self):
+        self.sync = SyncEngine(
+            root=self.config.upload_dir,
+            state_dir=os.path.join(self.get_plugin_data_folder(), "sync"),
+            url=self.config.sync_url,
+            make_headers=self.make_auth_header,
+            install=self.sync_install,
+            remove=self.sync_remove,
+            done=self.send_sync_result,
+            streams=self.config.sync_streams,
+            interval=self.config.sync_interval,
+            shaper=self.bulk,
+        )
+        self.sync.start()
+
+    def request_sync(self):
+        if self.sync is None:
+            self._logger.warning("Sync requested but it is not enabled")
+            return
+        sync_thread = threading.Thread(target=self.sync.run)
+        sync_thread.daemon = True
+        sync_thread.start()
+
+    def sync_install(self, path, temp_path):
+        # Synced files go through the file manager so that OctoPrint analyses
+        # them and fires its usual events.
+        path_in_storage = self._file_manager.path_in_storage(
+            FileDestinations.LOCAL, path)
+        if not self._printer.can_modify_file(path_in_storage, False):
+            raise IOError("File is in use: {}".format(path))
+        folder = posixpath.dirname(path)
+        if folder:
+            self._file_manager.add_folder(destination=FileDestinations.LOCAL,
+                                          path=folder,
+                                          ignore_existing=True)
+        self._file_manager.add_file(
+            destination=FileDestinations.LOCAL,
+            path=path,
+            file_object=DiskFileWrapper(posixpath.basename(path), temp_path),
+            allow_overwrite=True)
+
+    def sync_remove(self, path):
+        path_in_storage = self._file_manager.path_in_storage(
+            FileDestinations.LOCAL, path)
+        if not self._printer.can_modify_file(path_in_storage, False):
+            raise IOError("File is in use: {}".format(path))
+        self._file_manager.remove_file(destination=FileDestinations.LOCAL,
+                                       path=path)
+
+    def send_sync_result(self, summary):
+        self.telemetry.invalidate("files")
         if self.ws_connected():
+            self.ws.send_msg({
+                "sync": summary,
+                "timestamp": self.make_timestamp(),
+            })
+
+    def start_prefetch(self):
+        self.prefetch = Prefetcher(
+            url=self.config.request_url,
+            make_headers=self.make_auth_header,
+            install=self.prefetch_install,
+            local_path=lambda filename: self._file_manager.path_on_disk(
+                FileDestinations.LOCAL, filename),
+            done=self.send_prefetch_result,
+            lookahead=self.config.prefetch_lookahead,
+            rate=self.config.prefetch_max_rate * 1024,
+            shaper=self.bulk,
+        )
+        self.prefetch.start()
+
+    def prefetch_install(self, filename, temp_path):
+        # Prefetched files are analysed straight away so that printing them
+        # does not wait for the analysis either.
+        path = self.add_local_file(filename,
+                                   DiskFileWrapper(filename, temp_path))
+        if path is None:
+            raise IOError("File is in use: {}".format(filename))
+        if not self._file_manager.has_analysis(FileDestinations.LOCAL, path):
+            self._file_manager.analyse(FileDestinations.LOCAL, path)
+        return path
+
+    def send_prefetch_result(self, entry):
+        if self.ws_connected():
+            self.ws.send_msg({
+                "prefetch": entry,
+                "timestamp": self.make_timestamp(),
+            })
+
+    def get_camera_interval(self, camera):
+        if self.anomaly is not None:
+            return self.anomaly.interval(camera)
+        return self.config.camera_interval(camera)
+
+    def send_vibration(self, features):
+        if self.ws_connected():
+            msg = {
+                "vibration": features,
+                "timestamp": self.make_timestamp(),
+            }
+            self.ws.send_msg(msg)
+
+    def push_status(self, status):
+        self._plugin_manager.send_plugin_message(
+            self._identifier, dict(type="status", status=status))
+
+    def update_status(self):
+        link = self.link_stats()
+        rtt = link["rtt"]
+        queue_depth = link["unacked"]
+        if self.ws_available():
+            queue_depth += self.ws.queue_depth()
+        if self.gateway is not None:
+            queue_depth += self.gateway.queue_depth()
+        self.status.update(
+            ws_connected=bool(self.ws_connected()),
+            rtt=dict(p50=int(rtt["p50"]), p95=int(rtt["p95"])) if rtt["count"] else None,
+            queue_depth=queue_depth,
+        )
+
+    def event_ws_data(self, events, needs_state):
+        if needs_state:
+            data = self.ws_data(files=False)
+        else:
+            data = {"timestamp": self.make_timestamp()}
+        data["events"] = events
+        return data
+
+    def flush_events(self):
+        events, needs_state = self.events.take()
+        if events and self.ws_connected():
             try:
-                msg = self.event_ws_data(event, payload)
+                msg = self.event_ws_data(events, needs_state)
                 self.ws.send_msg(msg)
             except Exception as e:
                 self._logger.error(e)
                 pass
 
+    def on_event(self, event, payload):
+        self.tracer.event(event)
+        if self.archive is not None:
+            if event == "PrintStarted":
+                self.archive.start_job(payload.get("name", "print"))
+            elif event in ("PrintDone", "PrintFailed"):
+                self.archive.finish(success=event == "PrintDone")
+        if event in FILE_EVENTS:
+            if time.time() < self.files_quiet_until:
+                # The file tree went out with the batch reply, see run_batch.
+                self.telemetry.recheck("files")
+                return
+            self.telemetry.invalidate("files")
+        if self.ws_connected():
+            if self.events.add(event, payload):
+                self.flush_events()
+
     def is_enabled(self):
-        return self._settings.get(["enabled"])
+        return self.config.enabled
 
     def is_operational(self):
         return self._printer.is_ready() or self._printer.is_operational()
@@ -202,7 +680,7 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
         return self.get_base_url() and self.get_auth_token()
 
     def is_config_print(self):
-        return self._settings.get(["config_print"])
+        return self.config.config_print
 
     def has_job(self):
         if (self._printer.is_printing() or
@@ -218,6 +696,8 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
 
         return heating
 
+    # Rate floor for the telemetry topics, the topics themselves are only
+    # sent when they change beyond their deadband.
     def update_ws_send_interval(self):
         if self.active_online and self.has_job():
             self.ws_loop_time = 0.4
@@ -231,16 +711,22 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
         while True:
             try:
                 self.ws_connect()
-                loop_count = 0
+                if self.ws_connected():
+                    for frame in self.link.unacked():
+                        self.ws.send_msg(frame)
+                self.telemetry.reset()
                 loop_time = 0.1
                 while self.ws_connected():
-                    if self.ws_loop_time <= (loop_count * loop_time):
-                        msg = self.ws_data()
+                    self.tracer.flush()
+                    self.batches.deliver()
+                    if self.events.due():
+                        self.flush_events()
+                    msg = self.telemetry.poll(floor=self.ws_loop_time)
+                    if msg:
+                        msg["timestamp"] = self.make_timestamp()
                         self.ws.send_msg(msg)
-                        loop_count = 0
                     time.sleep(loop_time)
                     backoff.zero()
-                    loop_count += 1
 
             finally:
                 backoff.longer()
@@ -255,16 +741,50 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
 
     def ws_connect(self):
         self._logger.info("Connecting websocket")
-        self.ws = Socket(
+        callbacks = dict(
             on_open=lambda ws: self.ws_on_open(ws),
-            on_message=lambda ws, msg: self.ws_on_message(
-                ws, msg),
-            on_close=lambda ws: self.ws_on_close(ws),
+            on_message=lambda ws, msg: self.inbox.put(ws, msg),
+            on_close=lambda ws, *args: self.ws_on_close(ws),
             on_error=lambda ws, error: self.ws_on_error(
                 ws, error),
-            url=self.get_ws_url(),
-            token=self.get_auth_token()
         )
+        gateway_mode = self.get_gateway_mode()
+        if self.agent is not None:
+            self.ws = AgentSocket(
+                agent=self.agent,
+                url=self.get_ws_url(),
+                token=self.get_auth_token(),
+                heartbeat_interval=self.config.heartbeat_interval,
+                **callbacks
+            )
+        elif gateway_mode == "client":
+            self.ws = GatewayClient(
+                host=self.config.gateway_host,
+                port=self.config.gateway_port,
+                printer_id=self.get_printer_id(),
+                token=self.get_auth_token(),
+                secret=self.config.gateway_secret,
+                **callbacks
+            )
+        elif gateway_mode == "server" and self.gateway is not None:
+            self.ws = GatewaySocket(
+                gateway=self.gateway,
+                url=self.get_ws_url(),
+                token=self.get_auth_token(),
+                link=self.link,
+                heartbeat_interval=self.config.heartbeat_interval,
+                shaper=self.shaper,
+                **callbacks
+            )
+        else:
+            self.ws = Socket(
+                url=self.get_ws_url(),
+                token=self.get_auth_token(),
+                link=self.link,
+                heartbeat_interval=self.config.heartbeat_interval,
+                shaper=self.shaper,
+                **callbacks
+            )
         ws_thread = threading.Thread(target=self.ws.run)
         ws_thread.daemon = True
         ws_thread.start()
@@ -285,8 +805,7 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
 
     def ws_on_open(self, ws):
         self._logger.info("Opening websocket...")
-        self._settings.set(["ws_connected"], True, force=True)
-        self._settings.save(force=True)
+        self.status.update(ws_connected=True)
 
     def ws_on_close(self, ws):
         self._logger.info("Closing websocket...")
@@ -296,25 +815,35 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
         except Exception as e:
             self._logger.error("ws_on_close: %s", e)
             pass
-        self._settings.set(["ws_connected"], False, force=True)
-        self._settings.save(force=True)
+        self.status.update(ws_connected=False)
 
     def ws_on_error(self, ws, error):
         # TODO: handle websocket errors
         self._logger.error("ws_on_error: %s, URL: %s, Token: %s",
                            error, self.get_base_url(), self.get_auth_token())
 
+    def send_state(self):
+        if self.ws_connected():
+            try:
+                msg = self.ws_data()
+                self.ws.send_msg(msg)
+            except Exception as e:
+                self._logger.error("send_state: %s", e)
+                pass
+
     def ws_on_message(self, ws, msg):
         json_msg = json.loads(msg)
+        if self.gateway is not None and self.gateway.route(json_msg):
+            return
+        if "batch" in json_msg:
+            self.batches.submit(json_msg)
+        if "batch_ack" in json_msg:
+            self.batches.acked(json_msg["batch_ack"])
         if "cmd" in json_msg:
-            self.handle_cmds(json_msg)
-            if self.ws_connected():
-                try:
-                    msg = self.ws_data()
-                    self.ws.send_msg(msg)
-                except Exception as e:
-                    self._logger.error("ws_on_message: %s", e)
-                    pass
+            self.tracer.received(json_msg)
+            if not self.commands.submit(json_msg):
+                self.dispatch(json_msg)
+                self.send_state()
         if "state" in json_msg:
             if json_msg["state"].lower() == "active":
                 self.active_online = True
@@ -327,23 +856,115 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
                         pass
             else:
                 self.active_online = False
+        if "subscribe" in json_msg:
+            self.telemetry.subscribe(json_msg["subscribe"])
+        if "event_policies" in json_msg:
+            self.events.set_policies(json_msg["event_policies"])
+        if "job_queue" in json_msg:
+            if self.prefetch is not None:
+                self.prefetch.set_queue(json_msg["job_queue"])
+            else:
+                self._logger.warning("Job queue received but prefetch is not enabled")
         self.update_ws_send_interval()
 
-    def ws_data(self, extra_data=None):
+    def ws_data(self, extra_data=None, files=True):
         # TODO: Customise what is sent depending on requirements
         data = {
             "temperature_data": self.get_printer_temps(),
             "printer_data": self.get_printer_data(),
             "timestamp": self.make_timestamp(),
-            "files": self.get_files(),
             "job": self.get_current_job(),
         }
+        if files:
+            data["files"] = self.get_files()
         if extra_data:
             data.update(extra_data)
         return data
 
+    def dispatch(self, json_msg):
+        # Runs a command and times it for the tracer, coalesced commands
+        # carry the IDs of all the commands merged into them.
+        cids = json_msg.get("cids") or (
+            [json_msg["cid"]] if "cid" in json_msg else [])
+        self.tracer.dispatching(cids)
+        try:
+            self.handle_cmds(json_msg)
+        except Exception as e:
+            self.tracer.dispatched(cids, error=e)
+            raise
+        self.tracer.dispatched(cids)
+
+    def run_batch(self, json_msg):
+        # Runs a batch of commands in order and returns the result of each,
+        # which go back with a single state update, see send_batch_result.
+        # The file events the batch causes are not forwarded, the state
+        # carries the resulting file tree.
+        self.commands.flush()
+        batch = json_msg["batch"]
+        if not isinstance(batch, list):
+            self._logger.warning("Invalid command batch: %s", batch)
+            batch = []
+        results = []
+        self.files_quiet_until = float("inf")
+        try:
+            for index, (msg, covered) in enumerate(plan(batch)):
+                result = {"index": index}
+                error = validate(msg)
+                if error is None:
+                    result["cmd"] = msg["cmd"].lower()
+                    if "cid" in msg:
+                        result["cid"] = msg["cid"]
+                    if covered is not None:
+                        result["status"] = results[covered]["status"]
+                        if "error" in results[covered]:
+                            result["error"] = results[covered]["error"]
+                        result["covered_by"] = covered
+                    else:
+                        self.tracer.received(msg)
+                        try:
+                            self.dispatch(msg)
+                            result["status"] = "ok"
+                        except Exception as e:
+                            error = str(e)
+                if error is not None:
+                    result["status"] = "error"
+                    result["error"] = error
+                results.append(result)
+        finally:
+            self.files_quiet_until = time.time() + QUIET_PERIOD
+        return {
+            "batch_id": json_msg.get("batch_id"),
+            "results": results,
+            "errors": sum(1 for result in results
+                          if result["status"] == "error"),
+        }
+
+    def send_batch_result(self, batch_result):
+        # Returns True if the result went out, the state is built afresh
+        # each time so a resent result carries the current state.
+        if not self.ws_connected():
+            return False
+        try:
+            msg = self.ws_data(extra_data={"batch_result": batch_result})
+            self.telemetry.sent("files", msg["files"])
+            self.ws.send_msg(msg)
+            return True
+        except Exception as e:
+            self._logger.error("send_batch_result: %s", e)
+            return False
+
+    def send_command_ack(self, trace):
+        if self.ws_connected():
+            self.ws.send_msg({
+                "cmd_ack": trace,
+                "timestamp": self.make_timestamp(),
+            }, priority=CONTROL)
+
     def handle_cmds(self, json_msg):
         if "cmd" in json_msg:
+            # Lets the tracer see when the command's lines reach the printer.
+            tags = trace_tags(json_msg.get("cids") or (
+                [json_msg["cid"]] if "cid" in json_msg else []))
             if json_msg["cmd"].lower() == "pause":
                 self._printer.pause_print()
             if json_msg["cmd"].lower() == "resume":
@@ -367,35 +988,35 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
                 if "axes" in json_msg:
                     axes = json_msg["axes"]
                     # TODO: Deal with one or multiple axes
-                    self._printer.home(axes=axes)
+                    self._printer.home(axes=axes, tags=tags)
                 else:
-                    self._printer.home()
+                    self._printer.home(axes=["x", "y", "z"], tags=tags)
             if json_msg["cmd"].lower() == "jog":
                 if "axes" in json_msg:
                     axes = json_msg["axes"]
                     # TODO: Check if axes dict is valid
                     # Axes and distances to jog, keys are axes (“x”, “y”, “z”),
                     # values are distances in mm
-                    self._printer.jog(axes=axes, relative=True)
+                    self._printer.jog(axes=axes, relative=True, tags=tags)
             if json_msg["cmd"].lower() == "extrude":
                 if "amt" in json_msg:
                     amt = json_msg["amt"]
-                    self._printer.extrude(amount=amt)
+                    self._printer.extrude(amount=amt, tags=tags)
             if json_msg["cmd"].lower() == "retract":
                 if "amt" in json_msg:
                     amt = -json_msg["amt"]
-                    self._printer.extrude(amount=amt)
+                    self._printer.extrude(amount=amt, tags=tags)
             if json_msg["cmd"].lower() == "change_tool":
                 if "tool" in json_msg:
                     new_tool = "tool{}".format(json_msg["tool"])
-                    self._printer.change_tool(tool=new_tool)
+                    self._printer.change_tool(tool=new_tool, tags=tags)
             if json_msg["cmd"].lower() == "feed_rate":
                 if "factor" in json_msg:
                     new_factor = json_msg["factor"]
                     # TODO: Add checking to see if valid factor
                     # Percentage expressed as either an int between 0 and 100
                     # or a float between 0 and 1.
-                    self._printer.feed_rate(factor=new_factor)
+                    self._printer.feed_rate(factor=new_factor, tags=tags)
             if json_msg["cmd"].lower() == "flow_rate":
                 if "factor" in json_msg:
                     new_factor = json_msg["factor"]
@@ -403,13 +1024,13 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
                     # Percentage expressed as either an int between 0 and 100
                     # or a float between 0 and 1.
                     flow_cmd = "M221 S{}".format(new_factor)
-                    self._printer.commands(commands=flow_cmd)
-                    self._printer.commands(commands="M221")
+                    self._printer.commands(commands=flow_cmd, tags=tags)
+                    self._printer.commands(commands="M221", tags=tags)
             if json_msg["cmd"].lower() == "gcode":
                 if "commands" in json_msg:
                     gcode_cmds = json_msg["commands"]
                     # TODO: Check if single (str) or multiple (lst)
-                    self._printer.commands(commands=gcode_cmds)
+                    self._printer.commands(commands=gcode_cmds, tags=tags)
             if json_msg["cmd"].lower() == "temperature":
                 if "heater" in json_msg and "val" in json_msg:
                     # TODO: More elegantly handle different inputs
@@ -418,7 +1039,7 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
                     if heater != "bed":
                         heater = "tool{}".format(heater)
                     val = json_msg["val"]
-                    self._printer.set_temperature(heater=heater, value=val)
+                    self._printer.set_temperature(heater=heater, value=val, tags=tags)
             if json_msg["cmd"].lower() == "temperature_offset":
                 if "offsets" in json_msg:
                     # TODO: Validate the "offsets" dict
@@ -432,7 +1053,7 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
                 if "height" in json_msg:
                     height = json_msg["height"]
                     z_adjust_cmd = "M206 Z{}".format(height)
-                    self._printer.commands(commands=z_adjust_cmd)
+                    self._printer.commands(commands=z_adjust_cmd, tags=tags)
             if json_msg["cmd"].lower() == "upload_request":
                 # TODO: Add loc to server side
                 if "id" in json_msg and "loc" in json_msg:
@@ -445,12 +1066,18 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
                         location = FileDestinations.LOCAL
                         self._logger.warning("Invalid file destination: %s",
                                              json_msg["loc"].lower())
-                    path = self.post_upload_request(file_id=json_msg["id"])
+                    path = None
+                    if self.prefetch is not None and location == FileDestinations.LOCAL:
+                        path = self.prefetch.ready(json_msg["id"])
+                    if path is None:
+                        path = self.post_upload_request(file_id=json_msg["id"])
                     # TODO: Handle analysis for SD card files
                     is_analysed = self._file_manager.has_analysis(destination=location,
                                                                   path=path)
                     if not is_analysed:
                         pass
+            if json_msg["cmd"].lower() == "sync":
+                self.request_sync()
             if json_msg["cmd"].lower() == "new_folder":
                 if "folder" in json_msg and "loc" in json_msg:
                     folder_name = json_msg["folder"]
@@ -496,10 +1123,21 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
         content_disposition = resp.headers["Content-Disposition"]
         value, params = cgi.parse_header(content_disposition)
         filename = params["filename"]
-        file_content = resp.text.replace("\\n", "\n")
+        content = shaped_content(resp, self.bulk)
+        file_content = content.decode(resp.encoding or "utf-8", "replace").replace("\\n", "\n")
         stream = io.StringIO(file_content, newline="\n")
         stream_wrapper = StreamWrapper(filename, stream)
+        path = self.add_local_file(filename, stream_wrapper)
+        if path is not None and os.path.exists(path):
+            try:
+                os.remove(path)
+            except (OSError, IOError) as e:
+                pass
+        return path
 
+    def add_local_file(self, filename, file_object):
+        # Adds a file from the cloud to the local storage, reselecting it if
+        # it replaces the selected file. Returns None if the file is in use.
         try:
             future_path, future_filename = self._file_manager.sanitize(
                 FileDestinations.LOCAL, filename)
@@ -519,17 +1157,12 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
         # Destination both local and SD card.
         path = self._file_manager.add_file(destination=FileDestinations.LOCAL,
                                            path=filename,
-                                           file_object=stream_wrapper,
+                                           file_object=file_object,
                                            allow_overwrite=True)
-        if os.path.exists(path):
-            try:
-                os.remove(path)
-            except (OSError, IOError) as e:
-                pass
 
         if reselect:
             self._printer.select_file(self._file_manager.path_on_disk(FileDestinations.LOCAL,
-                                                                      added_file),
+                                                                      path),
                                       False)
         return path
 
@@ -548,9 +1181,17 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
             job_info = self.get_current_job()
             gcode_name = job_info["file"]["name"]
             gcode_path = job_info["file"]["path"]
-            upload_dir = self._settings.get(["upload_dir"])
+            upload_dir = self.config.upload_dir
             path = os.path.join(upload_dir, gcode_path)
-            if os.path.exists(path):
+            if self.agent is not None:
+                self.agent.send("gcode", {
+                    "url": self.get_gcode_url(),
+                    "headers": self.make_auth_header(),
+                    "path": path,
+                    "name": gcode_name,
+                    "timestamp": self.make_timestamp(),
+                })
+            elif os.path.exists(path):
                 try:
                     with open(path, "rb") as gcode:
                         data = MultipartEncoder(
@@ -568,7 +1209,7 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
                         try:
                             resp = requests.post(
                                 url=url,
-                                data=data,
+                                data=ShapedReader(data, self.shaper),
                                 headers=headers,
                             )
                             resp.raise_for_status()
@@ -636,6 +1277,8 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
             "camera": camera,
         }
 
+        self.shaper.acquire(len(raw_img), SNAPSHOT)
+        started = time.time()
         try:
             resp = requests.post(
                 url=url,
@@ -644,12 +1287,43 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
                 headers=self.make_auth_header()
             )
             resp.raise_for_status()
+            self.shaper.observe(len(raw_img), time.time() - started)
 
         except requests.exceptions.RequestException as e:
             self._logger.warning(
                 "Posting raw image: %s, URL: %s, Headers %s",
                 e, url, self.make_auth_header())
 
+    def post_snapshot(self, filename, raw_img, camera="primary", seq=0):
+        # Snapshots go over the open websocket when configured to, with the
+        # HTTP upload as the fallback.
+        if self.agent is not None:
+            self.agent.send("snapshot", {
+                "url": self.get_img_url(),
+                "headers": self.make_auth_header(),
+                "filename": filename,
+                "data": raw_img,
+                "camera": camera,
+                "timestamp": self.make_timestamp(),
+                "websocket": self.config.snapshot_transport == "websocket",
+                "job": self.get_current_job()["file"]["name"],
+                "seq": seq,
+            })
+            self.status.update(last_snapshot=self.make_timestamp())
+            return
+        sent = False
+        if (self.config.snapshot_transport == "websocket" and
+                self.ws_connected()):
+            sent = self.ws.send_image(
+                camera=1 if camera == "primary" else 2,
+                job=self.get_current_job()["file"]["name"],
+                seq=seq,
+                timestamp=time.time(),
+                data=raw_img)
+        if not sent:
+            self.post_raw_img(filename, raw_img, camera=camera)
+        self.status.update(last_snapshot=self.make_timestamp())
+
     def post_upload_request(self, file_id):
         self._logger.debug("Posting upload request")
 
@@ -672,7 +1346,8 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
             resp = requests.post(
                 url=url,
                 json=data,
-                headers=self.make_auth_header()
+                headers=self.make_auth_header(),
+                stream=True
             )
             resp.raise_for_status()
             path = self.process_response(resp)
@@ -715,6 +1390,9 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
     def is_api_adminonly(self):
         return True
 
+    def on_api_get(self, request):
+        return flask.jsonify(self.status.get())
+
     def on_api_command(self, command, data):
         if command == "test_auth_token":
             auth_token = data["auth_token"]
@@ -723,6 +1401,7 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
                 self._settings.set(["authorization_token"],
                                    auth_token, force=True)
                 self._settings.save(force=True)
+                self.reload_config()
             return flask.jsonify({"success": success, "text": status_text})
         if command == "ws_reconnect":
             self.ws_connect()
@@ -740,6 +1419,7 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
             previous_enabled = self._settings.get(["enabled"])
             self._settings.set(["enabled"], not previous_enabled, force=True)
             self._settings.save(force=True)
+            self.reload_config()
             is_enabled = self._settings.get(["enabled"])
             return flask.jsonify({"success": True, "enabled": is_enabled})
         if command == "set_config_print":
@@ -747,6 +1427,7 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
             self._settings.set(
                 ["config_print"], not previous_config_print, force=True)
             self._settings.save(force=True)
+            self.reload_config()
             is_config_print = not previous_config_print
             return flask.jsonify({"success": True, "config_print_enabled": is_config_print})
 
@@ -787,8 +1468,15 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
         elif self.is_operational():
             self.new_print_job = True
             self.snapshot_count = 0
+            if self.anomaly is not None:
+                self.anomaly.reset()
+
+    def on_gcode_sent(self, comm, phase, cmd, cmd_type, gcode, subcode=None,
+                      tags=None, *args, **kwargs):
+        self.tracer.sent(tags)
 
     def parse_received_lines(self, comm, line, *args, **kwargs):
+        self.tracer.line(line)
         if "Flow" in line:
             flow_regex = re.compile(r"Flow: (\d+)\%")
             match = flow_regex.search(line)
@@ -808,29 +1496,85 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
 
     def camera_snapshot(self, snapshot_url, cam_count=1):
         try:
-            resp = requests.get(
-                snapshot_url,
-                stream=True
-            )
-            resp.raw.decode_content = True
+            resp = requests.get(snapshot_url)
+            resp.raise_for_status()
             job_details = self.get_current_job()
             print_name, _ = os.path.splitext(job_details["file"]["name"])
             snapshot_name = '{}-{}-cam{}.jpg'.format(print_name,
                                                      self.snapshot_count,
                                                      cam_count)
+            seq = self.snapshot_count
             self.snapshot_count += 1
-            return snapshot_name, resp.raw
+            return snapshot_name, resp.content, seq
         except requests.exceptions.RequestException as e:
             self._logger.warning(
                 "Camera snapshot: %s, URL: %s",
                 e, snapshot_url)
-            return None, None
+            return None, None, None
+
+    def capture(self, camera):
+        # Returns how long until the camera's next snapshot is due, taking
+        # one first if it is due now.
+        interval = self.get_camera_interval(camera)
+        if (time.time() - self.last_capture[camera]) >= interval:
+            self.last_capture[camera] = time.time()
+            filename, img, seq = self.camera_snapshot(
+                self.config.snapshot_url(camera), cam_count=camera)
+            if filename and img:
+                self.frames.put(camera, img)
+                self.post_snapshot(filename, img,
+                                   camera="primary" if camera == 1 else "secondary",
+                                   seq=seq)
+                if self.anomaly is not None:
+                    self.anomaly.submit(camera, img)
+                if self.archive is not None:
+                    self.archive.add(camera, img)
+        return max(interval - (time.time() - self.last_capture[camera]), 0)
+
+    def fetch_frame(self, camera):
+        url = self.config.snapshot_url(camera)
+        try:
+            resp = requests.get(url, timeout=10)
+            resp.raise_for_status()
+            return resp.content
+        except requests.exceptions.RequestException as e:
+            self._logger.warning("Camera snapshot: %s, URL: %s", e, url)
+            return None
+
+    @octoprint.plugin.BlueprintPlugin.route("/snapshot/<int:camera>",
+                                            methods=["GET"])
+    def get_snapshot(self, camera):
+        # Serves the latest frame of a camera to consumers on the local
+        # network, so they share the plugin's snapshots rather than each
+        # polling the camera. Frames carry an ETag, a client which already
+        # has the current frame gets a 304.
+        if not self.config.frame_cache_enabled:
+            flask.abort(404)
+        # Behind a reverse proxy every request comes from localhost, the
+        # client is the one the trusted proxy names.
+        if not is_lan_address(get_remote_address(flask.request)):
+            flask.abort(403)
+        if camera not in (1, 2) or camera > self.config.num_cameras:
+            flask.abort(404)
+        frame = self.frames.get(camera, lambda: self.fetch_frame(camera))
+        if frame is None:
+            flask.abort(503)
+        response = flask.Response(frame.data, mimetype="image/jpeg")
+        response.set_etag(frame.etag)
+        response.cache_control.max_age = max(
+            int(self.config.frame_cache_ttl - frame.age()), 0)
+        return response.make_conditional(flask.request)
+
+    def is_blueprint_protected(self):
+        # Webcam consumers cannot log in, get_snapshot only answers the
+        # local network instead.
+        return False
 
     def loop(self):
-        camera_count_1 = 0
-        camera_count_2 = 0
         while True:
-            num_cameras = int(self._settings.get(["num_cameras"]))
+            self.update_status()
+            self.tracer.expire()
+            sleep_time = self.loop_time
             if self.is_enabled():
                 if not self.is_setup_complete():
                     self._logger.warning(
@@ -840,31 +1584,11 @@ class MattacloudPlugin(octoprint.plugin.StartupPlugin,
 
                 self.is_new_job()
 
-                if self.has_job() and num_cameras > 0:
-                    camera_interval_1 = int(
-                        self._settings.get(["camera_interval_1"]))
-                    if (camera_count_1 * self.loop_time) > camera_interval_1:
-                        snapshot_url = self._settings.get(["snapshot_url_1"])
-                        filename, img = self.camera_snapshot(snapshot_url)
-                        if filename and img:
-                            self.post_raw_img(filename, img, camera="primary")
-                        camera_count_1 = 0
-                    camera_count_1 += 1
-
-                    if num_cameras > 1:
-                        camera_interval_2 = int(
-                            self._settings.get(["camera_interval_2"]))
-                        if (camera_count_2 * self.loop_time) > camera_interval_2:
-                            snapshot_url = self._settings.get(
-                                ["snapshot_url_2"])
-                            filename, img = self.camera_snapshot(
-                                snapshot_url, cam_count=2)
-                            if filename and img:
-                                self.post_raw_img(filename, img, camera="secondary")
-                            camera_count_2 = 0
-                        camera_count_2 += 1
-
-            time.sleep(self.loop_time)
+                if self.has_job():
+                    for camera in range(1, min(self.config.num_cameras, 2) + 1):
+                        sleep_time = min(sleep_time, self.capture(camera))
+
+            time.sleep(sleep_time)
 
 
 __plugin_name__ = "Mattacloud"
@@ -877,4 +1601,5 @@ def __plugin_load__():
     __plugin_hooks__ = {
         "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
         "octoprint.comm.protocol.gcode.received": __plugin_implementation__.parse_received_lines,
+        "octoprint.comm.protocol.gcode.sent": __plugin_implementation__.on_gcode_sent,
     }
@@ -0,0 +1,454 @@
+from __future__ import absolute_import, unicode_literals, division, print_function
+import io
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import requests
+from requests_toolbelt import MultipartEncoder
+
+from .link import LinkMonitor
+from .shaper import (BULK, CLASSES, SNAPSHOT, TELEMETRY, ShapedReader,
+                     TrafficShaper)
+from .ws import Socket
+
+_logger = logging.getLogger("octoprint.plugins.mattacloud")
+
+connection_ids = itertools.count(1)
+
+
+class PipeHandler(logging.Handler):
+    # Hands the agent's log records to the plugin, which logs them.
+    def __init__(self, agent):
+        logging.Handler.__init__(self)
+        self.agent = agent
+
+    def emit(self, record):
+        try:
+            self.agent.send("log", record.levelno, self.format(record))
+        except Exception:
+            pass
+
+
+def post_image(url, headers, filename, data, camera, timestamp, shaper):
+    shaper.acquire(len(data), SNAPSHOT)
+    started = time.time()
+    try:
+        resp = requests.post(url=url,
+                             files={"img": (filename, data)},
+                             data={"timestamp": timestamp, "camera": camera},
+                             headers=headers)
+        resp.raise_for_status()
+        shaper.observe(len(data), time.time() - started)
+    except requests.exceptions.RequestException as e:
+        _logger.warning("Posting raw image: %s, URL: %s", e, url)
+
+
+def post_gcode(url, headers, path, name, timestamp, shaper):
+    try:
+        with io.open(path, "rb") as gcode:
+            data = MultipartEncoder(fields={
+                "gcode": (name, gcode, "text/plain"),
+                "timestamp": timestamp,
+            })
+            headers = dict(headers)
+            headers["Content-Type"] = data.content_type
+            resp = requests.post(url=url, data=ShapedReader(data, shaper),
+                                 headers=headers)
+            resp.raise_for_status()
+    except (OSError, IOError) as e:
+        _logger.warning("Failed to open gcode file: %s, Path: %s", e, path)
+    except requests.exceptions.RequestException as e:
+        _logger.warning("Posting gcode: %s, URL: %s", e, url)
+
+
+class Agent:
+    # Runs in the subprocess: owns the websocket, the link monitor and the
+    # shaper, and does the snapshot and gcode uploads, as told by the plugin
+    # over the pipe. The plugin's other HTTP traffic stays in process, see
+    # MattacloudPlugin.start_agent.
+    def __init__(self, conn, options):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.link = LinkMonitor(dead_timeout=options["link_timeout"])
+        self.shaper = TrafficShaper(options["bandwidth"], options["adaptive"])
+        self.socket = None
+        self.conn_id = None
+        self.jobs = queue.Queue(maxsize=20)
+        self.grants = [queue.Queue() for _ in CLASSES]
+
+    def send(self, *item):
+        with self.lock:
+            self.conn.send(item)
+
+    def run(self):
+        for target in (self.work, self.report):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+        for priority in range(len(CLASSES)):
+            thread = threading.Thread(target=self.grant, args=(priority,))
+            thread.daemon = True
+            thread.start()
+        while True:
+            try:
+                item = self.conn.recv()
+            except (EOFError, IOError, OSError):
+                break
+            if item[0] == "stop":
+                break
+            try:
+                getattr(self, "on_" + item[0])(*item[1:])
+            except Exception as e:
+                _logger.error("Agent %s: %s", item[0], e)
+        self.on_disconnect()
+
+    def on_connect(self, conn_id, options):
+        self.on_disconnect()
+        self.conn_id = conn_id
+        self.socket = Socket(
+            on_open=lambda ws: self.opened(conn_id),
+            on_message=lambda ws, msg: self.send("message", conn_id, msg),
+            on_close=lambda ws, *args: self.send("close", conn_id),
+            on_error=lambda ws, error: self.send("error", conn_id, str(error)),
+            url=options["url"],
+            token=options["token"],
+            link=self.link,
+            heartbeat_interval=options["heartbeat_interval"],
+            shaper=self.shaper,
+        )
+        thread = threading.Thread(target=self.socket.run)
+        thread.daemon = True
+        thread.start()
+
+    def opened(self, conn_id):
+        for frame in self.link.unacked():
+            self.socket.send_msg(frame)
+        self.send("open", conn_id)
+
+    def on_disconnect(self, conn_id=None):
+        if conn_id is not None and conn_id != self.conn_id:
+            return
+        socket, self.socket = self.socket, None
+        if socket is not None:
+            socket.disconnect()
+
+    def on_send(self, msg, priority):
+        if self.socket is not None:
+            self.socket.send_msg(msg, priority)
+
+    def on_configure(self, options):
+        self.link.dead_timeout = options["link_timeout"]
+        self.shaper.set_budget(options["bandwidth"], options["adaptive"])
+
+    def on_acquire(self, grant_id, nbytes, priority):
+        self.grants[priority].put((grant_id, nbytes))
+
+    def on_observe(self, nbytes, seconds):
+        self.shaper.observe(nbytes, seconds)
+
+    def grant(self, priority):
+        # Hands out the plugin's requests for tokens, one class per thread
+        # so a waiting bulk transfer never holds up a snapshot.
+        while True:
+            grant_id, nbytes = self.grants[priority].get()
+            self.shaper.acquire(nbytes, priority)
+            try:
+                self.send("granted", grant_id)
+            except (IOError, OSError, ValueError):
+                return
+
+    def on_snapshot(self, job):
+        try:
+            self.jobs.put_nowait(("snapshot", job))
+        except queue.Full:
+            _logger.warning("Agent is behind, dropping a snapshot")
+
+    def on_gcode(self, job):
+        self.jobs.put(("gcode", job))
+
+    def work(self):
+        while True:
+            kind, job = self.jobs.get()
+            try:
+                if kind == "gcode":
+                    post_gcode(shaper=self.shaper, **job)
+                    continue
+                websocket = job.pop("websocket")
+                name = job.pop("job")
+                seq = job.pop("seq")
+                socket = self.socket
+                if websocket and socket is not None and socket.connected():
+                    if socket.send_image(
+                            camera=1 if job["camera"] == "primary" else 2,
+                            job=name, seq=seq, timestamp=time.time(),
+                            data=job["data"]):
+                        continue
+                post_image(shaper=self.shaper, **job)
+            except Exception as e:
+                _logger.error("Agent %s: %s", kind, e)
+
+    def report(self):
+        while True:
+            socket = self.socket
+            try:
+                self.send("stats", {
+                    "link": self.link.stats(),
+                    "bandwidth": self.shaper.stats(),
+                    "queue_depth": (self.link.pending_count() +
+                                    self.jobs.qsize() +
+                                    (socket.queue_depth() if socket else 0)),
+                })
+            except (IOError, OSError, ValueError):
+                return
+            time.sleep(1)
+
+
+def agent_main(conn, options):
+    try:
+        os.nice(5)
+    except (AttributeError, OSError):
+        pass
+    agent = Agent(conn, options)
+    handler = PipeHandler(agent)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    _logger.addHandler(handler)
+    _logger.setLevel(logging.INFO)
+    _logger.propagate = False
+    agent.run()
+
+
+class AgentProcess:
+    # Supervises the agent subprocess from the plugin. Everything for the
+    # agent goes through a bounded outbox written by its own thread, so
+    # OctoPrint's threads never wait on the pipe however busy the cloud
+    # link is; when the outbox is full, frames are dropped. A dead agent is
+    # restarted, at most once every min_restart seconds.
+    def __init__(self, options, max_queue=1000, min_restart=10):
+        self.options = options
+        self.min_restart = min_restart
+        self.socket = None
+        self.stats = {}
+        self.process = None
+        self.conn = None
+        self.outbox = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.grants = {}
+        self.grant_ids = itertools.count(1)
+        self.grant_lock = threading.Lock()
+        self.started_at = 0
+        self.running = False
+        if hasattr(multiprocessing, "get_context"):
+            self.context = multiprocessing.get_context("spawn")
+        else:
+            self.context = multiprocessing
+
+    def start(self):
+        self.running = True
+        self.spawn()
+        for target in (self.write, self.supervise):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def spawn(self):
+        self.started_at = time.time()
+        conn, child_conn = self.context.Pipe()
+        self.process = self.context.Process(target=agent_main,
+                                            args=(child_conn, self.options))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self.conn = conn
+        thread = threading.Thread(target=self.read, args=(conn,))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.running = False
+        self.send("stop")
+        self.release_grants()
+        if self.process is not None:
+            self.process.join(5)
+            if self.process.is_alive():
+                self.process.terminate()
+
+    def configure(self, options):
+        self.options = options
+        self.send("configure", options)
+
+    def send(self, *item):
+        try:
+            self.outbox.put_nowait(item)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                _logger.warning("Agent is not keeping up, %s frames dropped",
+                                self.dropped)
+            return False
+
+    def acquire(self, nbytes, priority=BULK):
+        # Waits for tokens from the agent's shaper. Returns how long that
+        # took, or None if the request could not be handed to the agent.
+        if nbytes <= 0:
+            return 0
+        started = time.time()
+        grant = threading.Event()
+        with self.grant_lock:
+            grant_id = next(self.grant_ids)
+            self.grants[grant_id] = grant
+        try:
+            if not self.send("acquire", grant_id, nbytes, priority):
+                return None
+            while self.running and not grant.wait(1.0):
+                pass
+        finally:
+            with self.grant_lock:
+                self.grants.pop(grant_id, None)
+        return time.time() - started
+
+    def release_grants(self):
+        # Requests the agent will never answer, it stopped or died.
+        with self.grant_lock:
+            for grant in self.grants.values():
+                grant.set()
+
+    def pending(self):
+        return self.outbox.qsize()
+
+    def write(self):
+        while True:
+            item = self.outbox.get()
+            try:
+                self.conn.send(item)
+            except (EOFError, IOError, OSError, ValueError):
+                # The agent is gone and is restarted by supervise.
+                pass
+            if item[0] == "stop":
+                return
+
+    def read(self, conn):
+        while True:
+            try:
+                item = conn.recv()
+            except (EOFError, IOError, OSError):
+                return
+            if item[0] == "stats":
+                self.stats = item[1]
+            elif item[0] == "log":
+                _logger.log(item[1], "Agent: %s", item[2])
+            elif item[0] == "granted":
+                with self.grant_lock:
+                    grant = self.grants.get(item[1])
+                if grant is not None:
+                    grant.set()
+            else:
+                socket = self.socket
+                if socket is not None and socket.conn_id == item[1]:
+                    socket.handle(item[0], *item[2:])
+
+    def supervise(self):
+        while self.running:
+            time.sleep(1)
+            if not self.running or self.process.is_alive():
+                continue
+            _logger.warning("Agent exited with code %s, restarting it",
+                            self.process.exitcode)
+            self.stats = {}
+            self.release_grants()
+            socket = self.socket
+            if socket is not None:
+                socket.handle("close")
+            wait = self.min_restart - (time.time() - self.started_at)
+            if wait > 0:
+                time.sleep(wait)
+            if self.running:
+                self.spawn()
+
+
+class AgentShaper:
+    # Shaper for the transfers the plugin still makes itself: timelapse
+    # uploads, sync, prefetch and downloads. While the agent runs they take
+    # their tokens from its shaper, so everything sent shares one budget;
+    # otherwise, or if the agent can not be reached, from the plugin's own.
+    def __init__(self, agent, local):
+        self.agent = agent
+        self.local = local
+
+    def acquire(self, nbytes, priority=BULK):
+        agent = self.agent()
+        if agent is not None:
+            held = agent.acquire(nbytes, priority)
+            if held is not None:
+                return held
+        return self.local.acquire(nbytes, priority)
+
+    def observe(self, nbytes, seconds):
+        agent = self.agent()
+        if agent is None or not agent.send("observe", nbytes, seconds):
+            self.local.observe(nbytes, seconds)
+
+
+class AgentSocket:
+    # Drop-in replacement for Socket which hands the connection to the
+    # agent subprocess.
+    def __init__(self, agent, on_open, on_message, on_close, on_error, url,
+                 token, heartbeat_interval=2):
+        self.agent = agent
+        self.on_open = on_open
+        self.on_message = on_message
+        self.on_close = on_close
+        self.on_error = on_error
+        self.conn_id = next(connection_ids)
+        self.options = {
+            "url": url,
+            "token": token,
+            "heartbeat_interval": heartbeat_interval,
+        }
+        self.is_open = False
+        self.closed = False
+
+    def run(self):
+        self.agent.socket = self
+        self.agent.send("connect", self.conn_id, self.options)
+
+    def handle(self, kind, *args):
+        if kind == "open":
+            self.is_open = True
+            self.on_open(self)
+        elif kind == "message":
+            self.on_message(self, args[0])
+        elif kind == "error":
+            self.on_error(self, args[0])
+        elif kind == "close" and not self.closed:
+            self.closed = True
+            self.is_open = False
+            self.on_close(self)
+
+    def send_msg(self, msg, priority=TELEMETRY):
+        self.agent.send("send", msg, priority)
+
+    def send_image(self, camera, job, seq, timestamp, data):
+        # Snapshots go to the agent as a whole, see MattacloudPlugin.post_snapshot.
+        return False
+
+    def connected(self):
+        return self.is_open and not self.closed
+
+    def queue_depth(self):
+        return self.agent.stats.get("queue_depth", 0) + self.agent.pending()
+
+    def disconnect(self):
+        if not self.closed:
+            self.closed = True
+            self.is_open = False
+            self.agent.send("disconnect", self.conn_id)
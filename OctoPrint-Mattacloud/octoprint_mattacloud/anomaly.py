@@ -0,0 +1,236 @@
+from __future__ import absolute_import, unicode_literals, division, print_function
+import io
+import logging
+import math
+import multiprocessing
+import os
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import numpy as np
+    from PIL import Image
+except ImportError:
+    np = None
+    Image = None
+
+_logger = logging.getLogger("octoprint.plugins.mattacloud")
+
+
+def load_model(path):
+    # Returns a function scoring an RGB uint8 image between 0 and 1, using
+    # either an ONNX or a TFLite model with a single image input.
+    if path.endswith(".tflite"):
+        from tflite_runtime.interpreter import Interpreter
+        interpreter = Interpreter(model_path=path)
+        interpreter.allocate_tensors()
+        input_details = interpreter.get_input_details()[0]
+        output_details = interpreter.get_output_details()[0]
+        _, height, width, _ = input_details["shape"]
+
+        def run_tflite(image):
+            image = np.asarray(Image.fromarray(image).resize((width, height)))
+            tensor = image[np.newaxis].astype(input_details["dtype"])
+            if input_details["dtype"] == np.float32:
+                tensor /= 255.0
+            interpreter.set_tensor(input_details["index"], tensor)
+            interpreter.invoke()
+            output = interpreter.get_tensor(output_details["index"])
+            return float(np.ravel(output)[-1])
+        return run_tflite
+
+    import onnxruntime
+    session = onnxruntime.InferenceSession(path)
+    model_input = session.get_inputs()[0]
+    _, channels, height, width = [dim if isinstance(dim, int) else None
+                                  for dim in model_input.shape]
+    height = height or 224
+    width = width or 224
+
+    def run_onnx(image):
+        image = Image.fromarray(image).resize((width, height))
+        if channels == 1:
+            image = image.convert("L")
+        tensor = np.asarray(image, dtype=np.float32) / 255.0
+        if tensor.ndim == 2:
+            tensor = tensor[np.newaxis]
+        else:
+            tensor = tensor.transpose(2, 0, 1)
+        output = session.run(None, {model_input.name: tensor[np.newaxis]})
+        return float(np.ravel(output[0])[-1])
+    return run_onnx
+
+
+class FrameScorer:
+    # Scores how unusual a frame looks compared to the camera's recent
+    # frames. Each frame is reduced to three statistics (mean change from a
+    # slowly adapting background, fraction of strongly changed pixels and
+    # edge density) and the score is the largest deviation of these from
+    # their running averages, squashed into 0..1.
+    def __init__(self, model_path=None, size=(160, 120), alpha=0.05,
+                 warmup=5):
+        self.size = size
+        self.alpha = alpha
+        self.warmup = warmup
+        self.cameras = {}
+        self.model = load_model(model_path) if model_path else None
+
+    def metrics(self, frame, background):
+        diff = np.abs(frame - background)
+        grad_y, grad_x = np.gradient(frame)
+        return np.array([diff.mean(),
+                         (diff > 0.15).mean(),
+                         np.hypot(grad_x, grad_y).mean()])
+
+    def score(self, camera, data):
+        image = Image.open(io.BytesIO(data))
+        frame = np.asarray(image.convert("L").resize(self.size),
+                           dtype=np.float32) / 255.0
+        state = self.cameras.get(camera)
+        if state is None:
+            self.cameras[camera] = {"background": frame, "count": 0,
+                                    "mean": None, "var": None}
+            return 0.0
+
+        metrics = self.metrics(frame, state["background"])
+        state["background"] += self.alpha * (frame - state["background"])
+        state["count"] += 1
+        if state["mean"] is None:
+            state["mean"] = metrics
+            state["var"] = np.full_like(metrics, 1e-4)
+            return 0.0
+        deviation = (metrics - state["mean"]) / np.sqrt(state["var"] + 1e-8)
+        delta = metrics - state["mean"]
+        state["mean"] = state["mean"] + self.alpha * delta
+        state["var"] = (1 - self.alpha) * (state["var"] + self.alpha * delta ** 2)
+        if state["count"] <= self.warmup:
+            return 0.0
+
+        score = 1.0 / (1.0 + math.exp(-(float(deviation.max()) - 3.0)))
+        if self.model is not None:
+            score = max(score, self.model(np.asarray(image.convert("RGB"))))
+        return score
+
+
+def worker(requests, results, model_path):
+    try:
+        os.nice(10)
+    except (AttributeError, OSError):
+        pass
+    scorer = FrameScorer(model_path=model_path)
+    while True:
+        item = requests.get()
+        if item is None:
+            break
+        camera, data = item
+        try:
+            results.put((camera, scorer.score(camera, data), None))
+        except Exception as e:
+            results.put((camera, None, str(e)))
+
+
+class AdaptiveInterval:
+    # Snapshot interval of one camera. Drops to the floor as soon as a frame
+    # looks suspicious and backs off towards the ceiling while frames look
+    # normal.
+    def __init__(self, floor, ceiling, threshold, backoff=1.5):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.threshold = threshold
+        self.backoff = backoff
+        self.interval = floor
+
+    def update(self, score):
+        if score >= self.threshold:
+            self.interval = self.floor
+        else:
+            self.interval = min(self.ceiling, self.interval * self.backoff)
+
+    def reset(self):
+        self.interval = self.floor
+
+
+class AnomalyMonitor:
+    def __init__(self, floor, ceiling, threshold, model_path=None):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.threshold = threshold
+        self.model_path = model_path or None
+        self.intervals = {}
+        self.scores = {}
+        self.process = None
+        self.started_at = 0
+        if hasattr(multiprocessing, "get_context"):
+            self.context = multiprocessing.get_context("spawn")
+        else:
+            self.context = multiprocessing
+        self.requests = self.context.Queue(maxsize=4)
+        self.results = self.context.Queue()
+
+    @staticmethod
+    def available():
+        return np is not None and Image is not None
+
+    def start(self):
+        self.start_worker()
+        thread = threading.Thread(target=self.read_results)
+        thread.daemon = True
+        thread.start()
+
+    def start_worker(self):
+        self.started_at = time.time()
+        self.process = self.context.Process(
+            target=worker, args=(self.requests, self.results, self.model_path))
+        self.process.daemon = True
+        self.process.start()
+
+    def stop(self):
+        try:
+            self.requests.put_nowait(None)
+        except queue.Full:
+            pass
+        if self.process is not None:
+            self.process.join(5)
+            if self.process.is_alive():
+                self.process.terminate()
+            self.process = None
+
+    def camera(self, camera):
+        if camera not in self.intervals:
+            self.intervals[camera] = AdaptiveInterval(
+                self.floor, self.ceiling, self.threshold)
+        return self.intervals[camera]
+
+    def interval(self, camera):
+        return self.camera(camera).interval
+
+    def reset(self):
+        for interval in self.intervals.values():
+            interval.reset()
+
+    def submit(self, camera, data):
+        # Frames are dropped rather than queued up when the worker falls
+        # behind, the interval then simply stays where it is.
+        if self.process is None or not self.process.is_alive():
+            if time.time() - self.started_at < 60:
+                return
+            _logger.warning("Anomaly worker is not running, restarting it")
+            self.start_worker()
+        try:
+            self.requests.put_nowait((camera, data))
+        except queue.Full:
+            pass
+
+    def read_results(self):
+        while True:
+            camera, score, error = self.results.get()
+            if error is not None:
+                _logger.warning("Anomaly scoring camera %s: %s", camera, error)
+                continue
+            self.scores[camera] = score
+            self.camera(camera).update(score)
@@ -0,0 +1,139 @@
+from __future__ import absolute_import, unicode_literals, division, print_function
+import collections
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .config import string_types
+
+_logger = logging.getLogger("octoprint.plugins.mattacloud")
+
+# How long file events are still held back after a batch, OctoPrint
+# delivers them asynchronously.
+QUIET_PERIOD = 2.0
+
+
+def file_op(msg):
+    # Returns (cmd, loc, path, type) for file-manager commands, else None.
+    cmd = msg["cmd"].lower()
+    if cmd == "delete" and "file" in msg and "loc" in msg and "type" in msg:
+        return (cmd, msg["loc"].lower(), msg["file"].strip("/"),
+                msg["type"].lower())
+    if cmd == "new_folder" and "folder" in msg and "loc" in msg:
+        return cmd, msg["loc"].lower(), msg["folder"].strip("/"), "folder"
+    return None
+
+
+def within(path, folder):
+    return path == folder or path.startswith(folder + "/")
+
+
+def validate(msg):
+    if not isinstance(msg, dict):
+        return "Not a command"
+    if not isinstance(msg.get("cmd"), string_types):
+        return "Missing cmd"
+    return None
+
+
+def plan(commands):
+    # Returns each command with the index of an earlier command in the batch
+    # which already does its work, or None if it has to run. Within a run of
+    # deletes or of new folders, repeats are covered by the first, and
+    # deletes by the delete of a folder they are in.
+    planned = []
+    run = None
+    seen = {}
+    deleted = []
+    for index, msg in enumerate(commands):
+        op = file_op(msg) if validate(msg) is None else None
+        kind = op[0] if op is not None else None
+        if kind is None or kind != run:
+            run = kind
+            seen = {}
+            deleted = []
+        if op is None:
+            planned.append((msg, None))
+            continue
+        covered = seen.get(op)
+        if covered is None and kind == "delete":
+            for (loc, folder), folder_index in deleted:
+                if loc == op[1] and within(op[2], folder):
+                    covered = folder_index
+                    break
+        planned.append((msg, covered))
+        if covered is None:
+            seen[op] = index
+            if kind == "delete" and op[3] == "folder":
+                deleted.append(((op[1], op[2]), index))
+    return planned
+
+
+class BatchRunner:
+    # Runs batches one at a time on a thread of its own, so a long batch
+    # holds up neither the websocket nor other commands. Each result is
+    # kept until the cloud acknowledges it with a batch_ack, and is sent
+    # again on every new connection until then. Results of batches without
+    # a batch_id can not be acknowledged and are only sent once.
+    def __init__(self, run, send, connection, max_results=20):
+        self.run = run
+        self.send = send
+        self.connection = connection
+        self.max_results = max_results
+        self.batches = queue.Queue()
+        self.results = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def start(self):
+        thread = threading.Thread(target=self.loop)
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, json_msg):
+        self.batches.put(json_msg)
+
+    def loop(self):
+        while True:
+            json_msg = self.batches.get()
+            try:
+                result = self.run(json_msg)
+            except Exception as e:
+                _logger.error("Command batch: %s", e)
+                continue
+            with self.lock:
+                key = result["batch_id"]
+                if key is None:
+                    key = object()
+                self.results[key] = [result, None]
+                while len(self.results) > self.max_results:
+                    self.results.popitem(last=False)
+            self.deliver()
+
+    def acked(self, batch_id):
+        with self.lock:
+            self.results.pop(batch_id, None)
+
+    def pending(self):
+        with self.lock:
+            return len(self.results)
+
+    def deliver(self):
+        # Sends the results not yet sent over the current connection.
+        connection = self.connection()
+        if connection is None:
+            return
+        with self.lock:
+            due = []
+            for key, entry in self.results.items():
+                if entry[1] is not connection:
+                    entry[1] = connection
+                    due.append((key, entry))
+        for key, entry in due:
+            if not self.send(entry[0]):
+                entry[1] = None
+            elif entry[0]["batch_id"] is None:
+                self.acked(key)
@@ -0,0 +1,128 @@
+from __future__ import absolute_import, unicode_literals, division, print_function
+import logging
+import threading
+
+_logger = logging.getLogger("octoprint.plugins.mattacloud")
+
+# Relative moves which add up, command lists which concatenate and setpoints
+# of which only the latest value matters.
+ADDITIVE = ("jog", "extrude", "gcode")
+SETPOINTS = ("feed_rate", "flow_rate", "temperature")
+
+
+def normalise(json_msg):
+    msg = dict(json_msg)
+    msg["cmd"] = msg["cmd"].lower()
+    # Merged commands keep the correlation IDs of everything merged into them.
+    msg["cids"] = [msg.pop("cid")] if "cid" in msg else []
+    if msg["cmd"] == "retract" and "amt" in msg:
+        msg["cmd"] = "extrude"
+        msg["amt"] = -msg["amt"]
+    if msg["cmd"] == "gcode" and "commands" in msg:
+        if not isinstance(msg["commands"], list):
+            msg["commands"] = [msg["commands"]]
+    if msg["cmd"] == "jog" and "axes" in msg:
+        msg["axes"] = dict(msg["axes"])
+    return msg
+
+
+def sign(value):
+    return (value > 0) - (value < 0)
+
+
+def direction(msg):
+    # Relative moves only add up when they go the same way: jogs along the
+    # same axes in the same directions, extrudes or retracts but not both.
+    # A lift followed by a move across, or a purge followed by a retract,
+    # has to stay two moves.
+    if msg["cmd"] == "jog":
+        return sorted((axis, sign(distance))
+                      for axis, distance in msg["axes"].items())
+    if msg["cmd"] == "extrude":
+        return sign(msg["amt"])
+    return None
+
+
+def setpoint_key(msg):
+    if msg["cmd"] == "temperature":
+        return msg["cmd"], msg.get("heater")
+    return msg["cmd"], None
+
+
+class CommandCoalescer:
+    # Collects bursts of small commands from the cloud, e.g. a held jog
+    # button, and runs them merged once the window after the first command
+    # of the burst has passed. done is called once per burst so that only a
+    # single state update goes back.
+    def __init__(self, execute, done, window=0.15):
+        self.execute = execute
+        self.done = done
+        self.window = window
+        self.pending = []
+        self.timer = None
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    def coalescable(self, json_msg):
+        msg = normalise(json_msg)
+        if msg["cmd"] == "jog":
+            return "axes" in msg
+        if msg["cmd"] == "extrude":
+            return "amt" in msg
+        if msg["cmd"] == "gcode":
+            return "commands" in msg
+        return msg["cmd"] in SETPOINTS
+
+    def submit(self, json_msg):
+        # Returns False if the command can not be coalesced, the caller then
+        # runs it itself once everything before it has been flushed.
+        if not self.coalescable(json_msg):
+            self.flush()
+            return False
+        msg = normalise(json_msg)
+        with self.lock:
+            self.merge(msg)
+            if self.timer is None:
+                self.timer = threading.Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        return True
+
+    def merge(self, msg):
+        last = self.pending[-1] if self.pending else None
+        if (last is not None and last["cmd"] == msg["cmd"] and
+                msg["cmd"] in ADDITIVE and direction(last) == direction(msg)):
+            if msg["cmd"] == "jog":
+                for axis, distance in msg["axes"].items():
+                    last["axes"][axis] = last["axes"].get(axis, 0) + distance
+            elif msg["cmd"] == "extrude":
+                last["amt"] += msg["amt"]
+            else:
+                last["commands"].extend(msg["commands"])
+            last["cids"].extend(msg["cids"])
+            return
+        # A setpoint only replaces the one right before it, anything queued
+        # in between, e.g. an M104 in a gcode command, may depend on it.
+        if (last is not None and msg["cmd"] in SETPOINTS and
+                last["cmd"] in SETPOINTS and
+                setpoint_key(last) == setpoint_key(msg)):
+            msg["cids"] = last["cids"] + msg["cids"]
+            self.pending[-1] = msg
+            return
+        self.pending.append(msg)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                pending, self.pending = self.pending, []
+            if not pending:
+                return
+            for msg in pending:
+                try:
+                    self.execute(msg)
+                except Exception as e:
+                    _logger.error("Coalesced command %s: %s", msg["cmd"], e)
+            self.done()
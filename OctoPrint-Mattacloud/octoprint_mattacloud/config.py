@@ -0,0 +1,191 @@
+from __future__ import absolute_import, unicode_literals, division, print_function
+import collections
+import logging
+import socket
+
+try:
+    string_types = (str, unicode)
+except NameError:
+    string_types = (str,)
+
+_logger = logging.getLogger("octoprint.plugins.mattacloud")
+
+
+def text(value):
+    return "" if value is None else "{}".format(value).strip()
+
+
+def flag(value):
+    if isinstance(value, string_types):
+        return value.strip().lower() in ("true", "yes", "on", "1")
+    return bool(value)
+
+
+def bands(value):
+    return tuple((float(low), float(high)) for low, high in value)
+
+
+def policies(value):
+    return tuple(sorted(dict(value or {}).items()))
+
+
+# Settings the plugin reads at runtime and how each is converted. A value
+# which fails to convert falls back to its default.
+FIELDS = (
+    ("enabled", flag),
+    ("base_url", text),
+    ("authorization_token", text),
+    ("upload_dir", text),
+    ("config_print", flag),
+    ("num_cameras", int),
+    ("camera_interval_1", float),
+    ("camera_interval_2", float),
+    ("snapshot_url_1", text),
+    ("snapshot_url_2", text),
+    ("snapshot_transport", text),
+    ("anomaly_enabled", flag),
+    ("anomaly_interval_min", float),
+    ("anomaly_interval_max", float),
+    ("anomaly_threshold", float),
+    ("anomaly_model", text),
+    ("archive_enabled", flag),
+    ("archive_max_frames", int),
+    ("archive_max_mb", int),
+    ("archive_fps", int),
+    ("sync_enabled", flag),
+    ("sync_interval", float),
+    ("sync_streams", int),
+    ("prefetch_enabled", flag),
+    ("prefetch_lookahead", int),
+    ("prefetch_max_rate", float),
+    ("bandwidth_kbps", float),
+    ("bandwidth_adaptive", flag),
+    ("agent_enabled", flag),
+    ("frame_cache_enabled", flag),
+    ("frame_cache_ttl", float),
+    ("vibration_enabled", flag),
+    ("vibration_source", text),
+    ("vibration_sample_rate", float),
+    ("vibration_window", int),
+    ("vibration_bands", bands),
+    ("vibration_interval", float),
+    ("temperature_interval", float),
+    ("temperature_deadband", float),
+    ("progress_deadband", float),
+    ("telemetry_keepalive", float),
+    ("event_window", float),
+    ("command_window", float),
+    ("event_policies", policies),
+    ("heartbeat_interval", float),
+    ("link_timeout", float),
+    ("printer_id", text),
+    ("gateway_mode", text),
+    ("gateway_host", text),
+    ("gateway_port", int),
+    ("gateway_secret", text),
+)
+
+URLS = ("api_url", "ws_url", "ping_url", "data_url", "img_url", "gcode_url",
+        "request_url", "timelapse_url", "sync_url")
+
+# The fields each subsystem depends on, the subsystem is restarted or
+# retuned when any of them changes.
+SUBSYSTEMS = collections.OrderedDict([
+    ("agent", ("agent_enabled", "gateway_mode")),
+    ("gateway", ("gateway_mode", "gateway_port", "gateway_secret",
+                 "printer_id")),
+    ("websocket", ("base_url", "authorization_token", "gateway_mode",
+                   "gateway_host", "gateway_port", "printer_id",
+                   "gateway_secret", "heartbeat_interval",
+                   "agent_enabled")),
+    ("camera_1", ("num_cameras", "snapshot_url_1", "camera_interval_1")),
+    ("camera_2", ("num_cameras", "snapshot_url_2", "camera_interval_2")),
+    ("telemetry", ("temperature_interval", "temperature_deadband",
+                   "progress_deadband", "telemetry_keepalive")),
+    ("events", ("event_window", "event_policies")),
+    ("commands", ("command_window",)),
+    ("link", ("link_timeout",)),
+    ("shaper", ("bandwidth_kbps", "bandwidth_adaptive")),
+    ("frames", ("frame_cache_ttl",)),
+    ("vibration", ("vibration_enabled", "vibration_source",
+                   "vibration_sample_rate", "vibration_window",
+                   "vibration_bands", "vibration_interval")),
+    ("anomaly", ("anomaly_enabled", "anomaly_interval_min",
+                 "anomaly_interval_max", "anomaly_threshold",
+                 "anomaly_model")),
+    ("archive", ("archive_enabled", "archive_max_frames", "archive_max_mb",
+                 "archive_fps", "base_url")),
+    ("sync", ("sync_enabled", "sync_interval", "sync_streams", "upload_dir",
+              "base_url")),
+    ("prefetch", ("prefetch_enabled", "prefetch_lookahead",
+                  "prefetch_max_rate", "base_url")),
+])
+
+
+class Config(collections.namedtuple(
+        "Config", [name for name, _ in FIELDS] + list(URLS))):
+    # Immutable snapshot of the plugin's settings, built once per settings
+    # save so the hot loops never go through OctoPrint's settings layer.
+    __slots__ = ()
+
+    @classmethod
+    def load(cls, get, defaults):
+        values = {}
+        for name, convert in FIELDS:
+            try:
+                values[name] = convert(get(name))
+            except (TypeError, ValueError):
+                _logger.warning("Invalid setting %s: %r", name, get(name))
+                values[name] = convert(defaults[name])
+
+        url = values["base_url"]
+        if url.startswith("/"):
+            url = url[1:]
+        if url.endswith("/"):
+            url = url[:-1]
+        values["base_url"] = url
+        if not values["printer_id"]:
+            values["printer_id"] = socket.gethostname()
+        if values["gateway_mode"] not in ("off", "server", "client"):
+            _logger.warning("Invalid gateway mode: %s", values["gateway_mode"])
+            values["gateway_mode"] = "off"
+        if values["snapshot_transport"] not in ("http", "websocket"):
+            _logger.warning("Invalid snapshot transport: %s",
+                            values["snapshot_transport"])
+            values["snapshot_transport"] = "http"
+
+        if url:
+            api_url = url + "/api"
+            values.update(
+                api_url=api_url,
+                ws_url=(api_url + "/ws/printer/").replace("http", "ws"),
+                ping_url=api_url + "/ping/",
+                data_url=api_url + "/receive/data/",
+                img_url=api_url + "/receive/img/",
+                gcode_url=api_url + "/receive/gcode/",
+                request_url=api_url + "/receive/request/",
+                timelapse_url=api_url + "/receive/timelapse/",
+                sync_url=api_url + "/sync/",
+            )
+        else:
+            values.update((name, None) for name in URLS)
+        return cls(**values)
+
+    def snapshot_url(self, camera):
+        return getattr(self, "snapshot_url_{}".format(camera))
+
+    def camera_interval(self, camera):
+        return getattr(self, "camera_interval_{}".format(camera))
+
+
+def changed_fields(old, new):
+    return set(name for name, _ in FIELDS
+               if getattr(old, name) != getattr(new, name))
+
+
+def affected(old, new):
+    # Returns the subsystems touched by a settings change, in the order they
+    # should be restarted in.
+    fields = changed_fields(old, new)
+    return [name for name, depends in SUBSYSTEMS.items()
+            if fields.intersection(depends)]
@@ -0,0 +1,129 @@
+from __future__ import absolute_import, unicode_literals, division, print_function
+import logging
+import threading
+import time
+
+_logger = logging.getLogger("octoprint.plugins.mattacloud")
+
+IMMEDIATE = "immediate"
+COALESCE = "coalesce"
+AGGREGATE = "aggregate"
+DROP = "drop"
+
+POLICIES = (IMMEDIATE, COALESCE, AGGREGATE, DROP)
+
+# Events not listed here are forwarded immediately.
+DEFAULT_POLICIES = {
+    "ZChange": COALESCE,
+    "PositionUpdate": COALESCE,
+    "UpdatedFiles": COALESCE,
+    "SettingsUpdated": COALESCE,
+    "FileAdded": AGGREGATE,
+    "FileRemoved": AGGREGATE,
+    "FolderAdded": AGGREGATE,
+    "FolderRemoved": AGGREGATE,
+    "MetadataAnalysisStarted": AGGREGATE,
+    "MetadataAnalysisFinished": AGGREGATE,
+    "MetadataStatisticsUpdated": AGGREGATE,
+    "CaptureStart": DROP,
+    "CaptureDone": DROP,
+    "CaptureFailed": DROP,
+    "ClientOpened": DROP,
+    "ClientAuthed": DROP,
+    "ClientClosed": DROP,
+}
+
+# Events which change the file tree.
+FILE_EVENTS = frozenset([
+    "UpdatedFiles",
+    "FileAdded",
+    "FileRemoved",
+    "FolderAdded",
+    "FolderRemoved",
+])
+
+# Events after which the cloud needs the printer's state alongside them.
+STATE_EVENTS = frozenset([
+    "Connected",
+    "Disconnected",
+    "PrinterStateChanged",
+    "FileSelected",
+    "FileDeselected",
+    "PrintStarted",
+    "PrintDone",
+    "PrintFailed",
+    "PrintCancelled",
+    "PrintPaused",
+    "PrintResumed",
+    "Error",
+])
+
+
+class EventBatcher:
+    def __init__(self, window=0.5, policies=None):
+        self.window = window
+        self.policies = dict(DEFAULT_POLICIES)
+        self.lock = threading.Lock()
+        self.events = []
+        self.merged = {}
+        self.first_at = None
+        self.urgent = False
+        if policies:
+            self.set_policies(policies)
+
+    def set_policies(self, policies):
+        with self.lock:
+            for event, policy in policies.items():
+                if policy not in POLICIES:
+                    _logger.warning("Invalid policy %s for event %s",
+                                    policy, event)
+                    continue
+                self.policies[event] = policy
+
+    def policy(self, event):
+        return self.policies.get(event, IMMEDIATE)
+
+    def add(self, event, payload):
+        # Returns True if the batch should be flushed straight away.
+        policy = self.policy(event)
+        if policy == DROP:
+            return False
+        with self.lock:
+            if self.first_at is None:
+                self.first_at = time.time()
+            if policy in (COALESCE, AGGREGATE) and event in self.merged:
+                entry = self.merged[event]
+                entry["count"] += 1
+                if policy == COALESCE:
+                    entry["payload"] = payload
+                return False
+            entry = {
+                "event_type": event,
+                "payload": None if policy == AGGREGATE else payload,
+            }
+            if policy in (COALESCE, AGGREGATE):
+                entry["count"] = 1
+                self.merged[event] = entry
+            self.events.append(entry)
+            if policy == IMMEDIATE:
+                self.urgent = True
+            return self.urgent
+
+    def due(self, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            return bool(self.events) and (
+                self.urgent or (now - self.first_at) >= self.window)
+
+    def take(self):
+        # Returns the batched events and whether the state must go with them.
+        with self.lock:
+            events = self.events
+            self.events = []
+            self.merged = {}
+            self.first_at = None
+            self.urgent = False
+        needs_state = any(entry["event_type"] in STATE_EVENTS
+                          for entry in events)
+        return events, needs_state
@@ -0,0 +1,53 @@
+from __future__ import absolute_import, unicode_literals, division, print_function
+import hashlib
+import threading
+import time
+
+
+class Frame:
+    def __init__(self, data, captured=None):
+        self.data = data
+        self.captured = captured if captured is not None else time.time()
+        self.etag = hashlib.sha1(data).hexdigest()[:16]
+
+    def age(self, now=None):
+        return (now if now is not None else time.time()) - self.captured
+
+
+class FrameCache:
+    # Latest frame of each camera, so local consumers can reuse the frames
+    # the plugin captures instead of each asking the camera for its own. A
+    # request for a frame older than ttl fetches a new one, and concurrent
+    # requests for the same camera wait for that one fetch.
+    def __init__(self, ttl=2.0):
+        self.ttl = ttl
+        self.frames = {}
+        self.lock = threading.Lock()
+        self.fetch_locks = {}
+
+    def put(self, camera, data):
+        frame = Frame(data)
+        with self.lock:
+            self.frames[camera] = frame
+        return frame
+
+    def latest(self, camera):
+        with self.lock:
+            return self.frames.get(camera)
+
+    def get(self, camera, fetch):
+        # Returns a frame at most ttl seconds old, or None if the camera
+        # could not be reached.
+        frame = self.latest(camera)
+        if frame is not None and frame.age() < self.ttl:
+            return frame
+        with self.lock:
+            fetch_lock = self.fetch_locks.setdefault(camera, threading.Lock())
+        with fetch_lock:
+            frame = self.latest(camera)
+            if frame is not None and frame.age() < self.ttl:
+                return frame
+            data = fetch()
+            if not data:
+                return None
+            return self.put(camera, data)
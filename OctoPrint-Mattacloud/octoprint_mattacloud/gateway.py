@@ -0,0 +1,317 @@
+from __future__ import absolute_import, unicode_literals, division, print_function
+import collections
+import hmac
+import json
+import logging
+import socket
+import threading
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from .config import string_types
+from .shaper import CLASSES, CONTROL, TELEMETRY
+from .ws import Socket
+
+_logger = logging.getLogger("octoprint.plugins.mattacloud")
+
+
+def encode_line(msg):
+    if isinstance(msg, dict):
+        msg = json.dumps(msg)
+    return (msg + "\n").encode("utf-8")
+
+
+class Gateway:
+    # Local aggregator which multiplexes the frames of many printers over
+    # one upstream websocket, tagging each frame with its printer ID.
+    # Frames wait here, one queue per printer and priority class, and are
+    # handed upstream a round at a time only while the upstream socket has
+    # little queued, so it is the rounds which decide who goes next.
+    # Control frames are never dropped, the others are when a printer's
+    # queue of that class is full.
+    # Printers must know the gateway's secret, and an ID can only be
+    # connected once, so no host on the LAN can take over another printer's
+    # commands.
+    def __init__(self, printer_id, port, secret, queue_size=50):
+        self.printer_id = printer_id
+        self.secret = secret
+        self.port = port
+        self.queue_size = queue_size
+        self.upstream = None
+        self.clients = {}
+        self.queues = collections.OrderedDict()
+        self.lock = threading.Condition()
+        self.server = None
+        self.running = False
+
+    def start(self):
+        gateway = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                gateway.handle_client(self)
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer(("", self.port), Handler)
+        self.server.daemon_threads = True
+        self.running = True
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        scheduler_thread = threading.Thread(target=self.schedule)
+        scheduler_thread.daemon = True
+        scheduler_thread.start()
+        _logger.info("Gateway listening on port %s", self.port)
+        if not self.secret:
+            _logger.warning("No gateway secret is set, printers can not "
+                            "connect to the gateway")
+
+    def stop(self):
+        self.running = False
+        with self.lock:
+            self.lock.notify_all()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def attach(self, upstream):
+        with self.lock:
+            self.upstream = upstream
+            self.lock.notify_all()
+
+    def enqueue(self, printer_id, msg, priority=None):
+        if not isinstance(msg, dict):
+            msg = json.loads(msg)
+        # Printers behind the gateway tell it the class of their frames.
+        sent_priority = msg.pop("gateway_priority", None)
+        if priority is None:
+            priority = sent_priority
+        if priority not in range(len(CLASSES)):
+            priority = TELEMETRY
+        msg["printer_id"] = printer_id
+        with self.lock:
+            if printer_id not in self.queues:
+                self.queues[printer_id] = [
+                    collections.deque() if each == CONTROL else
+                    collections.deque(maxlen=self.queue_size)
+                    for each in range(len(CLASSES))]
+            self.queues[printer_id][priority].append(msg)
+            self.lock.notify_all()
+
+    def queue_depth(self):
+        with self.lock:
+            return sum(len(queue) for queues in self.queues.values()
+                       for queue in queues)
+
+    def pending(self):
+        return any(queue for queues in self.queues.values()
+                   for queue in queues)
+
+    def next_round(self):
+        # The most urgent frame of every printer with pending frames, so a
+        # chatty printer can never starve the others of the upstream link.
+        frames = []
+        for queues in self.queues.values():
+            for priority, queue in enumerate(queues):
+                if queue:
+                    frames.append((queue.popleft(), priority))
+                    break
+        return frames
+
+    def frame_sent(self):
+        with self.lock:
+            self.lock.notify_all()
+
+    def upstream_connected(self):
+        return self.upstream is not None and self.upstream.connected()
+
+    def upstream_ready(self):
+        # Room for a round, with at most about one round still queued.
+        return (self.upstream_connected() and
+                self.upstream.backlog() < max(len(self.queues), 1))
+
+    def schedule(self):
+        while self.running:
+            with self.lock:
+                while self.running and not (self.upstream_ready() and
+                                            self.pending()):
+                    self.lock.wait(1.0)
+                if not self.running:
+                    return
+                frames = self.next_round()
+                upstream = self.upstream
+            for frame, priority in frames:
+                upstream.send_upstream(frame, priority)
+
+    def route(self, json_msg):
+        # Returns True if the cloud message was meant for a downstream
+        # printer and has been forwarded to it.
+        printer_id = json_msg.get("printer_id")
+        if not printer_id or printer_id == self.printer_id:
+            return False
+        with self.lock:
+            client = self.clients.get(printer_id)
+        if client is None:
+            _logger.warning("Gateway: no printer connected with ID %s",
+                            printer_id)
+            return True
+        try:
+            client.write(json_msg)
+        except (IOError, OSError) as e:
+            _logger.error("Gateway route: %s", e)
+        return True
+
+    def register(self, printer_id, secret, client):
+        # Returns why the printer may not connect, or None once registered.
+        if not self.secret:
+            return "no gateway secret is set"
+        if (not isinstance(secret, string_types) or
+                not hmac.compare_digest(secret.encode("utf-8"),
+                                        self.secret.encode("utf-8"))):
+            return "wrong gateway secret"
+        if printer_id == self.printer_id:
+            return "printer ID of the gateway"
+        with self.lock:
+            if printer_id in self.clients:
+                return "printer ID already connected"
+            self.clients[printer_id] = client
+        return None
+
+    def handle_client(self, handler):
+        hello = handler.rfile.readline()
+        if not hello:
+            return
+        try:
+            hello = json.loads(hello.decode("utf-8"))
+            printer_id = hello["hello"]
+        except (ValueError, KeyError) as e:
+            _logger.warning("Gateway: invalid hello from %s: %s",
+                            handler.client_address, e)
+            return
+        client = GatewayConnection(handler)
+        error = self.register(printer_id, hello.get("secret"), client)
+        if error is not None:
+            _logger.warning("Gateway: rejected printer %s from %s: %s",
+                            printer_id, handler.client_address[0], error)
+            try:
+                client.write({"gateway": "rejected", "reason": error})
+            except (IOError, OSError):
+                pass
+            return
+        _logger.info("Gateway: printer %s connected from %s",
+                     printer_id, handler.client_address[0])
+        self.enqueue(printer_id, {"gateway": "connected",
+                                  "token": hello.get("token")})
+        try:
+            for line in iter(handler.rfile.readline, b""):
+                try:
+                    self.enqueue(printer_id, line.decode("utf-8"))
+                except ValueError as e:
+                    _logger.warning("Gateway: invalid frame from %s: %s",
+                                    printer_id, e)
+        finally:
+            with self.lock:
+                if self.clients.get(printer_id) is client:
+                    del self.clients[printer_id]
+            self.enqueue(printer_id, {"gateway": "disconnected"})
+            _logger.info("Gateway: printer %s disconnected", printer_id)
+
+
+class GatewayConnection:
+    def __init__(self, handler):
+        self.handler = handler
+        self.lock = threading.Lock()
+
+    def write(self, msg):
+        with self.lock:
+            self.handler.wfile.write(encode_line(msg))
+            self.handler.wfile.flush()
+
+
+class GatewaySocket(Socket):
+    # Upstream websocket of a gateway. Local frames are queued alongside
+    # the downstream printers' frames rather than sent directly.
+    def __init__(self, gateway, **kwargs):
+        Socket.__init__(self, **kwargs)
+        self.gateway = gateway
+        self.gateway.attach(self)
+
+    def send_msg(self, msg, priority=None):
+        self.gateway.enqueue(self.gateway.printer_id, msg, priority)
+
+    def send_upstream(self, msg, priority):
+        Socket.send_msg(self, msg, priority)
+
+    def frame_sent(self):
+        self.gateway.frame_sent()
+
+
+class GatewayClient():
+    # Drop-in replacement for Socket which reports to a gateway over the
+    # LAN instead of opening its own connection to the cloud.
+    def __init__(self, on_open, on_message, on_close, on_error, host, port,
+                 printer_id, token, secret):
+        self.on_open = on_open
+        self.on_message = on_message
+        self.on_close = on_close
+        self.on_error = on_error
+        self.address = (host, port)
+        self.printer_id = printer_id
+        self.token = token
+        self.secret = secret
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def run(self):
+        try:
+            self.sock = socket.create_connection(self.address, timeout=10)
+            self.sock.settimeout(None)
+            self.send_msg({"hello": self.printer_id, "token": self.token,
+                           "secret": self.secret})
+            self.on_open(self)
+            reader = self.sock.makefile("rb")
+            for line in iter(reader.readline, b""):
+                self.on_message(self, line.decode("utf-8"))
+        except Exception as e:
+            _logger.error("GatewayClient run: %s", e)
+            self.on_error(self, e)
+        finally:
+            if self.sock is not None:
+                self.on_close(self)
+
+    def send_msg(self, msg, priority=None):
+        # Frames to the gateway stay on the LAN and are not shaped, the
+        # gateway queues them by their class.
+        if isinstance(msg, dict) and priority is not None:
+            msg = dict(msg, gateway_priority=priority)
+        try:
+            if self.connected():
+                with self.lock:
+                    self.sock.sendall(encode_line(msg))
+        except Exception as e:
+            _logger.error("GatewayClient send_msg: %s", e)
+            pass
+
+    def connected(self):
+        return self.sock is not None
+
+    def send_image(self, camera, job, seq, timestamp, data):
+        # Snapshots go straight to the cloud over HTTP from gateway clients.
+        return False
+
+    def queue_depth(self):
+        return 0
+
+    def disconnect(self):
+        _logger.info("Disconnecting from the gateway...")
+        sock, self.sock = self.sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except (IOError, OSError):
+                pass
+            sock.close()
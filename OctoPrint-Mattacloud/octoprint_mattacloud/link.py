@@ -0,0 +1,124 @@
+from __future__ import absolute_import, unicode_literals, division, print_function
+import collections
+import threading
+import time
+
+
+class LatencyHistogram:
+    # Rolling window of latencies in milliseconds.
+    buckets = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+    def __init__(self, window=200):
+        self.samples = collections.deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def add(self, rtt):
+        with self.lock:
+            self.samples.append(rtt * 1000.0)
+
+    def percentile(self, samples, pct):
+        index = int(round(pct / 100.0 * (len(samples) - 1)))
+        return samples[index]
+
+    def summary(self):
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return {"count": 0}
+        counts = [0] * (len(self.buckets) + 1)
+        for sample in samples:
+            bucket = 0
+            while bucket < len(self.buckets) and sample > self.buckets[bucket]:
+                bucket += 1
+            counts[bucket] += 1
+        return {
+            "count": len(samples),
+            "mean": round(sum(samples) / len(samples), 1),
+            "p50": round(self.percentile(samples, 50), 1),
+            "p95": round(self.percentile(samples, 95), 1),
+            "p99": round(self.percentile(samples, 99), 1),
+            "max": round(samples[-1], 1),
+            "buckets": list(self.buckets),
+            "counts": counts,
+        }
+
+
+class LinkMonitor:
+    # Tracks the health of the cloud link. Outgoing frames are numbered and,
+    # once the cloud has shown that it sends acks, held until acknowledged.
+    # Every heartbeat pong and ack feeds the latency histogram and the link
+    # is declared dead when nothing has been heard for dead_timeout seconds.
+    def __init__(self, dead_timeout=6, window=200, max_pending=100):
+        self.dead_timeout = dead_timeout
+        self.max_pending = max_pending
+        self.latency = LatencyHistogram(window)
+        self.seq = 0
+        self.pending = collections.OrderedDict()
+        self.last_received = time.time()
+        self.connections = 0
+        self.acking = False
+        self.lock = threading.Lock()
+
+    def opened(self):
+        with self.lock:
+            self.last_received = time.time()
+            self.connections += 1
+
+    def sent(self, frame):
+        with self.lock:
+            self.seq += 1
+            frame["seq"] = self.seq
+            if not self.acking:
+                return frame
+            self.pending[self.seq] = (time.time(), frame)
+            while len(self.pending) > self.max_pending:
+                self.pending.popitem(last=False)
+        return frame
+
+    def received(self):
+        with self.lock:
+            self.last_received = time.time()
+
+    def acked(self, seq):
+        # Acks are cumulative, everything up to seq has been delivered.
+        now = time.time()
+        with self.lock:
+            self.last_received = now
+            self.acking = True
+            sent_at = None
+            while self.pending:
+                first = next(iter(self.pending))
+                if first > seq:
+                    break
+                sent_at, _ = self.pending.pop(first)
+        if sent_at is not None:
+            self.latency.add(now - sent_at)
+
+    def pong(self, payload):
+        self.received()
+        try:
+            sent_at = float(payload)
+        except (TypeError, ValueError):
+            return
+        self.latency.add(time.time() - sent_at)
+
+    def is_dead(self):
+        return (time.time() - self.last_received) > self.dead_timeout
+
+    def unacked(self):
+        # Frames sent since the last ack, to be resent after a reconnect.
+        with self.lock:
+            frames = [frame for _, frame in self.pending.values()]
+            self.pending.clear()
+        return frames
+
+    def pending_count(self):
+        with self.lock:
+            return len(self.pending)
+
+    def stats(self):
+        return {
+            "rtt": self.latency.summary(),
+            "unacked": self.pending_count(),
+            "connections": self.connections,
+        }
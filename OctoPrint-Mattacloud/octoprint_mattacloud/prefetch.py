@@ -0,0 +1,179 @@
+from __future__ import absolute_import, unicode_literals, division, print_function
+import cgi
+import collections
+import hashlib
+import io
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import requests
+
+from .shaper import BULK
+from .sync import file_digest
+
+_logger = logging.getLogger("octoprint.plugins.mattacloud")
+
+
+class RateLimiter:
+    # Token bucket capping a transfer at rate bytes per second.
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else self.rate
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def throttle(self, nbytes):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= nbytes
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+def unescape(chunks):
+    # The cloud sends gcode with escaped newlines, see process_response. A
+    # backslash at the end of a chunk is held back until the next one.
+    held = b""
+    for chunk in chunks:
+        chunk = held + chunk
+        held = b""
+        if chunk.endswith(b"\\"):
+            chunk, held = chunk[:-1], b"\\"
+        yield chunk.replace(b"\\n", b"\n")
+    if held:
+        yield held
+
+
+class Prefetcher:
+    # Downloads the files of the next jobs in the cloud's queue in the
+    # background, one at a time and bandwidth capped, so a print of a queued
+    # file does not wait for its download. Files are checked against the
+    # queue's sha256 digest before they are added to the library.
+    def __init__(self, url, make_headers, install, local_path, done=None,
+                 lookahead=3, rate=524288, chunk_size=16384, shaper=None):
+        self.url = url
+        self.shaper = shaper
+        self.make_headers = make_headers
+        self.install = install
+        self.local_path = local_path
+        self.done = done
+        self.lookahead = lookahead
+        self.limiter = RateLimiter(rate)
+        self.chunk_size = chunk_size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Condition()
+        self.running = False
+
+    def start(self):
+        self.running = True
+        thread = threading.Thread(target=self.loop)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.running = False
+        with self.lock:
+            self.lock.notify_all()
+
+    def set_queue(self, jobs):
+        # Replaces the lookahead queue, files already fetched stay ready.
+        with self.lock:
+            entries = collections.OrderedDict()
+            for job in jobs:
+                if "id" not in job or "file" not in job:
+                    _logger.warning("Invalid prefetch job: %s", job)
+                    continue
+                entry = self.entries.get(job["id"])
+                if entry is None or entry["status"] == "failed":
+                    entry = dict(job, status="queued", path=None)
+                entries[job["id"]] = entry
+            self.entries = entries
+            self.lock.notify_all()
+
+    def queue(self):
+        with self.lock:
+            return [dict(entry) for entry in self.entries.values()]
+
+    def ready(self, file_id):
+        # Returns the path of a prefetched file, or None.
+        with self.lock:
+            entry = self.entries.get(file_id)
+            if entry is not None and entry["status"] == "ready":
+                return entry["path"]
+        return None
+
+    def next_entry(self):
+        for entry in list(self.entries.values())[:self.lookahead]:
+            if entry["status"] == "queued":
+                return entry
+        return None
+
+    def loop(self):
+        while self.running:
+            with self.lock:
+                entry = self.next_entry()
+                while self.running and entry is None:
+                    self.lock.wait(5)
+                    entry = self.next_entry()
+                if not self.running:
+                    return
+                entry["status"] = "downloading"
+            try:
+                entry["path"] = self.fetch(entry)
+                entry["status"] = "ready"
+            except Exception as e:
+                _logger.warning("Prefetching %s: %s", entry["file"], e)
+                entry["status"] = "failed"
+                entry["error"] = str(e)
+            if self.done is not None:
+                self.done(dict(entry))
+
+    def fetch(self, entry):
+        local_path = self.local_path(entry["file"])
+        if (local_path is not None and entry.get("digest") and
+                os.path.exists(local_path) and
+                file_digest(local_path) == entry["digest"]):
+            return entry["file"]
+
+        data = {"status": "ready", "type": "file", "file_id": entry["id"],
+                "prefetch": True}
+        resp = requests.post(self.url, json=data, headers=self.make_headers(),
+                             stream=True, timeout=60)
+        try:
+            resp.raise_for_status()
+            _, params = cgi.parse_header(resp.headers["Content-Disposition"])
+            filename = params["filename"]
+            digest = hashlib.sha256()
+            handle, temp_path = tempfile.mkstemp(suffix=".gcode")
+            try:
+                with io.open(handle, "wb") as out:
+                    for chunk in unescape(resp.iter_content(self.chunk_size)):
+                        self.limiter.throttle(len(chunk))
+                        if self.shaper is not None:
+                            self.shaper.acquire(len(chunk), BULK)
+                        digest.update(chunk)
+                        out.write(chunk)
+                if entry.get("digest") and digest.hexdigest() != entry["digest"]:
+                    raise ValueError("Checksum mismatch")
+                path = self.install(filename, temp_path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        finally:
+            resp.close()
+
+        data["status"] = "success"
+        try:
+            requests.post(self.url, json=data, headers=self.make_headers(),
+                          timeout=60).raise_for_status()
+        except requests.exceptions.RequestException as e:
+            _logger.warning("Prefetch success report: %s, URL: %s", e, self.url)
+        return path
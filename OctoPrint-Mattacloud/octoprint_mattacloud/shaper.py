@@ -0,0 +1,164 @@
+from __future__ import absolute_import, unicode_literals, division, print_function
+import logging
+import threading
+import time
+
+_logger = logging.getLogger("octoprint.plugins.mattacloud")
+
+# Priority classes, lower goes first.
+CONTROL = 0
+TELEMETRY = 1
+SNAPSHOT = 2
+BULK = 3
+
+CLASSES = ("control", "telemetry", "snapshot", "bulk")
+
+
+class TrafficShaper:
+    # Token bucket shared by everything the plugin sends. A sender waits
+    # until the bucket holds enough tokens and no sender of a higher class is
+    # waiting; control traffic is never held back but still uses up tokens.
+    # Transfers bigger than the bucket are let through a bucketful at a
+    # time, so they never leave it in debt and higher classes get in
+    # between.
+    # With adaptive set, transfers report how fast they actually went and
+    # the rate follows the measured capacity of the link, up to the budget.
+    # A rate of 0 turns shaping off.
+    def __init__(self, rate=0, adaptive=True, burst=0.25, min_rate=8192,
+                 min_sample=65536):
+        self.burst_time = burst
+        self.min_rate = min_rate
+        self.min_sample = min_sample
+        self.adaptive = adaptive
+        self.budget = 0
+        self.rate = 0
+        self.measured = None
+        self.tokens = 0
+        self.updated = time.time()
+        self.waiting = [0] * len(CLASSES)
+        self.sent = [0] * len(CLASSES)
+        self.lock = threading.Condition()
+        self.set_budget(rate, adaptive)
+
+    def set_budget(self, rate, adaptive=True):
+        with self.lock:
+            self.budget = rate
+            self.rate = rate
+            self.adaptive = adaptive
+            self.measured = None
+            self.tokens = self.burst()
+            self.updated = time.time()
+            self.lock.notify_all()
+
+    def burst(self):
+        return max(self.rate * self.burst_time, 16384)
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.burst(),
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, nbytes, priority=BULK):
+        # Returns how long the sender was held back for.
+        if nbytes <= 0:
+            return 0
+        started = time.time()
+        with self.lock:
+            self.sent[priority] += nbytes
+            if self.rate <= 0:
+                return 0
+            if priority == CONTROL:
+                self.refill()
+                self.tokens -= nbytes
+                return 0
+            remaining = nbytes
+            self.waiting[priority] += 1
+            try:
+                while remaining > 0 and self.rate > 0:
+                    self.refill()
+                    need = min(remaining, self.burst())
+                    if (self.tokens >= need and
+                            not any(self.waiting[:priority])):
+                        self.tokens -= need
+                        remaining -= need
+                        continue
+                    wait = max(need - self.tokens, 0) / self.rate
+                    self.lock.wait(min(max(wait, 0.01), 1.0))
+            finally:
+                self.waiting[priority] -= 1
+                self.lock.notify_all()
+        return time.time() - started
+
+    def observe(self, nbytes, seconds):
+        # Adapts the rate to a transfer which took seconds to send nbytes,
+        # not counting the time it was held back by the shaper.
+        if (not self.adaptive or self.budget <= 0 or seconds <= 0 or
+                nbytes < self.min_sample):
+            return
+        throughput = nbytes / seconds
+        with self.lock:
+            if self.measured is None:
+                self.measured = throughput
+            else:
+                self.measured = 0.8 * self.measured + 0.2 * throughput
+            if throughput < 0.9 * self.rate:
+                rate = max(self.min_rate, 0.9 * self.measured)
+                if rate < self.rate:
+                    _logger.info("Link slower than the bandwidth budget, "
+                                 "shaping at %d kbit/s", rate * 8 / 1000)
+                    self.rate = rate
+            else:
+                self.rate = min(self.budget, self.rate * 1.05)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "budget_kbps": round(self.budget * 8 / 1000.0, 1),
+                "rate_kbps": round(self.rate * 8 / 1000.0, 1),
+                "measured_kbps": (round(self.measured * 8 / 1000.0, 1)
+                                  if self.measured is not None else None),
+                "bytes": dict(zip(CLASSES, self.sent)),
+            }
+
+
+class ShapedReader:
+    # File-like wrapper which sends a request body through the shaper, a
+    # block at a time, and reports the throughput once it is read. length
+    # is needed for a Content-Length unless the stream has a len.
+    def __init__(self, stream, shaper, priority=BULK, length=None):
+        self.stream = stream
+        self.shaper = shaper
+        self.priority = priority
+        if length is not None:
+            self.len = length
+        elif hasattr(stream, "len"):
+            self.len = stream.len
+        self.started = None
+        self.finished = False
+        self.held = 0
+        self.total = 0
+
+    def read(self, size=-1):
+        if self.started is None:
+            self.started = time.time()
+        data = self.stream.read(size)
+        if data:
+            self.held += self.shaper.acquire(len(data), self.priority)
+            self.total += len(data)
+        elif not self.finished:
+            self.finished = True
+            self.shaper.observe(self.total,
+                                time.time() - self.started - self.held)
+        return data
+
+
+def shaped_chunks(resp, shaper, priority=BULK, chunk_size=16384):
+    # Yields a streamed response body through the shaper.
+    for chunk in resp.iter_content(chunk_size):
+        shaper.acquire(len(chunk), priority)
+        yield chunk
+
+
+def shaped_content(resp, shaper, priority=BULK, chunk_size=16384):
+    return b"".join(shaped_chunks(resp, shaper, priority, chunk_size))
@@ -65,6 +65,21 @@ $(function() {
     self.is_octoprint_admin = ko.observable(self.loginState.isAdmin());
 
     self.ws_status = ko.observable();
+    self.rtt = ko.observable();
+    self.queue_depth = ko.observable(0);
+    self.last_snapshot = ko.observable();
+
+    self.rtt_text = ko.pureComputed(function() {
+      var rtt = self.rtt();
+      if (!rtt) {
+        return "-";
+      }
+      return rtt.p50 + " ms (p95 " + rtt.p95 + " ms)";
+    }, self);
+
+    self.last_snapshot_text = ko.pureComputed(function() {
+      return self.last_snapshot() ? self.last_snapshot() + " UTC" : "-";
+    }, self);
 
     self.camera_numbers = ko.observable([
       { key: "0", name: gettext("0") },
@@ -223,12 +238,26 @@ $(function() {
     update_status_text = function() {
       var status_text = "Disconnected.";
       if (self.ws_connected()) {
-        console.log(self.ws_connected());
         status_text = "Connected to the mattacloud.";
       }
       self.ws_status(status_text);
     };
 
+    apply_status = function(status) {
+      self.ws_connected(status.ws_connected);
+      self.rtt(status.rtt);
+      self.queue_depth(status.queue_depth);
+      self.last_snapshot(status.last_snapshot);
+      update_status_text();
+    };
+
+    self.onDataUpdaterPluginMessage = function(plugin, data) {
+      if (plugin != "mattacloud" || data.type != "status") {
+        return;
+      }
+      apply_status(data.status);
+    };
+
     self.onBeforeBinding = function() {
       self.auth_token(
         self.settings.settings.plugins.mattacloud.authorization_token()
@@ -239,9 +268,6 @@ $(function() {
         self.settings.settings.plugins.mattacloud.config_print()
       );
       self.enabled_value(self.settings.settings.plugins.mattacloud.enabled());
-      self.ws_connected(
-        self.settings.settings.plugins.mattacloud.ws_connected()
-      );
       self.num_cameras(self.settings.settings.plugins.mattacloud.num_cameras());
       self.camera_interval_1(
         self.settings.settings.plugins.mattacloud.camera_interval_1()
@@ -255,7 +281,12 @@ $(function() {
       self.snapshot_url_2(
         self.settings.settings.plugins.mattacloud.snapshot_url_2()
       );
-      update_status_text();
+      $.ajax({
+        url: "./api/plugin/mattacloud",
+        type: "GET",
+        dataType: "json",
+        success: apply_status
+      });
     };
   }
   // This is how our plugin registers itself with the application, by adding some configuration
@@ -0,0 +1,52 @@
+from __future__ import absolute_import, unicode_literals, division, print_function
+import logging
+import threading
+import time
+
+_logger = logging.getLogger("octoprint.plugins.mattacloud")
+
+
+class StatusPublisher:
+    # Holds the plugin's status in memory and pushes it to the frontend.
+    # Bursts of updates are debounced and pushes are rate limited, so a
+    # flapping connection costs a handful of messages rather than a
+    # settings write per flap.
+    def __init__(self, send, min_interval=1.0, debounce=0.25):
+        self.send = send
+        self.min_interval = min_interval
+        self.debounce = debounce
+        self.status = {}
+        self.last_sent = 0
+        self.lock = threading.Lock()
+        self.changed = threading.Event()
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def update(self, **fields):
+        with self.lock:
+            if all(self.status.get(key) == value
+                   for key, value in fields.items()):
+                return
+            self.status.update(fields)
+        self.changed.set()
+
+    def get(self):
+        with self.lock:
+            return dict(self.status)
+
+    def run(self):
+        while True:
+            self.changed.wait()
+            time.sleep(self.debounce)
+            wait = self.min_interval - (time.time() - self.last_sent)
+            if wait > 0:
+                time.sleep(wait)
+            self.changed.clear()
+            self.last_sent = time.time()
+            try:
+                self.send(self.get())
+            except Exception as e:
+                _logger.error("Status push: %s", e)
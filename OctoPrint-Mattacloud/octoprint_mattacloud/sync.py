@@ -0,0 +1,656 @@
+from __future__ import absolute_import, unicode_literals, division, print_function
+import base64
+import hashlib
+import io
+import json
+import logging
+import math
+import mmap
+import multiprocessing
+import os
+import posixpath
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import requests
+
+from .shaper import BULK, shaped_chunks
+
+_logger = logging.getLogger("octoprint.plugins.mattacloud")
+
+MIN_BLOCK = 2048
+MAX_BLOCK = 65536
+MAX_LITERAL = 1048576
+ADLER = 65521
+
+
+def block_size_for(size):
+    # rsync's rule of thumb, blocks of about the square root of the file.
+    block_size = int(math.sqrt(size)) // 1024 * 1024
+    return max(MIN_BLOCK, min(MAX_BLOCK, block_size))
+
+
+def weak_sum(data):
+    return zlib.adler32(data) & 0xffffffff
+
+
+def strong_sum(data):
+    return hashlib.md5(data).hexdigest()[:16]
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with io.open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(MAX_LITERAL), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def open_map(f, size):
+    if size == 0:
+        return b""
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def signatures(path, block_size):
+    # Weak and strong checksum of every block, the last one may be short.
+    sums = []
+    if path is None or not os.path.exists(path):
+        return sums
+    with io.open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sums.append([weak_sum(block), strong_sum(block)])
+    return sums
+
+
+class Delta:
+    # Builds the ops which turn the other side's copy, described by its block
+    # signatures, into the local file: ["c", first block, count] copies
+    # blocks the other side has, ["l", offset, length] is new data, which
+    # goes over the wire as ["d", base64] ops, see delta_body.
+    def __init__(self, block_size, sums, max_scan=64):
+        self.block_size = block_size
+        self.sums = sums
+        self.max_scan = max_scan * block_size
+        self.table = {}
+        for index, (weak, strong) in enumerate(sums):
+            self.table.setdefault(weak, []).append((strong, index))
+        self.ops = []
+        self.literal_bytes = 0
+
+    def find(self, weak, block):
+        candidates = self.table.get(weak)
+        if not candidates:
+            return None
+        strong = strong_sum(block)
+        for candidate, index in candidates:
+            if candidate == strong:
+                return index
+        return None
+
+    def copy(self, index):
+        last = self.ops[-1] if self.ops else None
+        if last is not None and last[0] == "c" and last[1] + last[2] == index:
+            last[2] += 1
+        else:
+            self.ops.append(["c", index, 1])
+
+    def literal(self, start, end):
+        if end <= start:
+            return
+        last = self.ops[-1] if self.ops else None
+        if last is not None and last[0] == "l" and last[1] + last[2] == start:
+            last[2] += end - start
+        else:
+            self.ops.append(["l", start, end - start])
+        self.literal_bytes += end - start
+
+    def build(self, path):
+        size = os.path.getsize(path)
+        block_size = self.block_size
+        if not self.sums:
+            # Nothing on the other side to copy from.
+            self.literal(0, size)
+            return self.ops
+        with io.open(path, "rb") as f:
+            data = open_map(f, size)
+            try:
+                pos = literal_start = 0
+                while pos + block_size <= size:
+                    block = data[pos:pos + block_size]
+                    weak = weak_sum(block)
+                    index = self.find(weak, block)
+                    if index is not None:
+                        self.literal(literal_start, pos)
+                        self.copy(index)
+                        pos = literal_start = pos + block_size
+                        continue
+                    # Roll the weak checksum byte by byte until a block
+                    # matches again, for at most max_scan bytes at a time.
+                    scan_end = min(size - block_size, pos + self.max_scan)
+                    window = bytearray(data[pos:scan_end + block_size])
+                    a, b = weak & 0xffff, weak >> 16
+                    found = None
+                    for offset in range(scan_end - pos):
+                        out, new = window[offset], window[offset + block_size]
+                        a = (a - out + new) % ADLER
+                        b = (b - block_size * out + a - 1) % ADLER
+                        if ((b << 16) | a) in self.table:
+                            start = pos + offset + 1
+                            index = self.find((b << 16) | a,
+                                              data[start:start + block_size])
+                            if index is not None:
+                                found = start, index
+                                break
+                    if found is None:
+                        pos = scan_end + 1
+                        continue
+                    start, index = found
+                    self.literal(literal_start, start)
+                    self.copy(index)
+                    pos = literal_start = start + block_size
+                tail = data[pos:size]
+                index = None
+                if tail and self.sums and len(tail) < block_size:
+                    index = self.find(weak_sum(tail), tail)
+                    if index != len(self.sums) - 1:
+                        index = None
+                if index is not None:
+                    self.literal(literal_start, pos)
+                    self.copy(index)
+                else:
+                    self.literal(literal_start, size)
+            finally:
+                if size:
+                    data.close()
+        return self.ops
+
+
+def build_delta(path, block_size, sums):
+    delta = Delta(block_size, sums)
+    return delta.build(path), delta.literal_bytes
+
+
+def lower_priority():
+    try:
+        os.nice(10)
+    except (AttributeError, OSError):
+        pass
+
+
+def delta_body(fields, path, ops, shaper=None, held=None):
+    # Yields the JSON body of a patch upload, fields plus the ops, reading
+    # and encoding the new data a MAX_LITERAL piece at a time so a large
+    # file is never held in memory. The time spent waiting on the shaper is
+    # added up in held.
+    head = json.dumps(fields)
+    yield (head[:-1] + ', "ops": [').encode("utf-8")
+    separator = ""
+    with io.open(path, "rb") as f:
+        for op in ops:
+            if op[0] != "l":
+                yield (separator + json.dumps(op)).encode("utf-8")
+                separator = ", "
+                continue
+            f.seek(op[1])
+            remaining = op[2]
+            while remaining > 0:
+                data = f.read(min(MAX_LITERAL, remaining))
+                if not data:
+                    raise ValueError("File changed while it was uploaded")
+                remaining -= len(data)
+                if shaper is not None:
+                    waited = shaper.acquire(len(data), BULK)
+                    if held is not None:
+                        held[0] += waited
+                yield (separator + json.dumps(
+                    ["d", base64.b64encode(data).decode("ascii")])).encode("utf-8")
+                separator = ", "
+    yield b"]}"
+
+
+class OpStream:
+    # Reads the ops of a delta response, {"ops": [...]}, from its chunks as
+    # they arrive. The base64 data of a ["d", ...] op is handed on in pieces
+    # rather than read whole, so patch() writes it out as it comes in.
+    whitespace = b" \t\r\n"
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = b""
+        self.pos = 0
+
+    def fill(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            raise ValueError("Delta response ended early")
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+    def next_char(self, skip=whitespace):
+        while True:
+            while self.pos < len(self.buf):
+                char = self.buf[self.pos:self.pos + 1]
+                self.pos += 1
+                if char not in skip:
+                    return char
+            self.fill()
+
+    def expect(self, char, skip=whitespace):
+        if self.next_char(skip) != char:
+            raise ValueError("Invalid delta response")
+
+    def until(self, end):
+        while True:
+            index = self.buf.find(end, self.pos)
+            if index >= 0:
+                data = self.buf[self.pos:index]
+                self.pos = index + 1
+                return data
+            self.fill()
+
+    def string(self):
+        # Yields the rest of a string in pieces, up to its closing quote.
+        while True:
+            index = self.buf.find(b'"', self.pos)
+            if index >= 0:
+                piece = self.buf[self.pos:index]
+                self.pos = index + 1
+                yield piece
+                return
+            piece = self.buf[self.pos:]
+            self.pos = len(self.buf)
+            yield piece
+            self.fill()
+
+    def ops(self):
+        while True:
+            index = self.buf.find(b'"ops"', self.pos)
+            if index >= 0:
+                self.pos = index + len(b'"ops"')
+                break
+            self.pos = max(self.pos, len(self.buf) - len(b'"ops"'))
+            self.fill()
+        self.expect(b":")
+        self.expect(b"[")
+        while True:
+            char = self.next_char(self.whitespace + b",")
+            if char == b"]":
+                return
+            if char != b"[":
+                raise ValueError("Invalid delta response")
+            self.expect(b'"')
+            kind = self.until(b'"')
+            if kind == b"c":
+                rest = self.until(b"]").decode("ascii")
+                yield json.loads('["c"' + rest + "]")
+                continue
+            self.expect(b'"', self.whitespace + b",")
+            pieces = self.string()
+            yield ["d", pieces]
+            for _ in pieces:
+                pass
+            self.expect(b"]")
+
+
+def write_data(out, data):
+    # Decodes base64 data, whole or in pieces, into out.
+    if isinstance(data, (bytes, type(""))):
+        data = [data]
+    received = 0
+    rest = b""
+    for piece in data:
+        if not isinstance(piece, bytes):
+            piece = piece.encode("ascii")
+        # JSON may escape the slashes of base64.
+        rest += piece.replace(b"\\", b"")
+        usable = len(rest) // 4 * 4
+        if usable:
+            decoded = base64.b64decode(rest[:usable])
+            out.write(decoded)
+            received += len(decoded)
+            rest = rest[usable:]
+    if rest:
+        raise ValueError("Truncated delta data")
+    return received
+
+
+def patch(base_path, block_size, ops, output):
+    # Rebuilds a file from a local base copy and the ops of a Delta, a list
+    # or an OpStream.
+    received = 0
+    base = None
+    if base_path is not None and os.path.exists(base_path):
+        base = io.open(base_path, "rb")
+    try:
+        with io.open(output, "wb") as out:
+            for op in ops:
+                if op[0] == "c":
+                    if base is None:
+                        raise ValueError("Delta copies from a missing file")
+                    base.seek(op[1] * block_size)
+                    for _ in range(op[2]):
+                        out.write(base.read(block_size))
+                else:
+                    received += write_data(out, op[1])
+    finally:
+        if base is not None:
+            base.close()
+    return received
+
+
+def safe_path(path):
+    path = posixpath.normpath(path.replace("\\", "/")).lstrip("/")
+    if path.startswith("..") or path == ".":
+        raise ValueError("Invalid sync path: {}".format(path))
+    return path
+
+
+class Manifest:
+    # (size, mtime, digest) of every file under root, and the digest each
+    # file had when it was last in sync with the cloud. Digests are only
+    # recomputed for files whose size or mtime changed.
+    def __init__(self, root, path):
+        self.root = root
+        self.path = path
+        self.files = {}
+        self.base = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            try:
+                with io.open(path) as f:
+                    state = json.load(f)
+                self.files = state.get("files", {})
+                self.base = state.get("base", {})
+            except (IOError, OSError, ValueError) as e:
+                _logger.warning("Sync manifest: %s", e)
+
+    def scan(self):
+        files = {}
+        for folder, dirs, names in os.walk(self.root):
+            dirs[:] = [name for name in dirs if not name.startswith(".")]
+            for name in names:
+                if name.startswith("."):
+                    continue
+                full_path = os.path.join(folder, name)
+                path = os.path.relpath(full_path, self.root).replace(os.sep, "/")
+                try:
+                    stat = os.stat(full_path)
+                    cached = self.files.get(path)
+                    if (cached and cached["size"] == stat.st_size and
+                            cached["mtime"] == stat.st_mtime):
+                        files[path] = cached
+                        continue
+                    files[path] = {"size": stat.st_size,
+                                   "mtime": stat.st_mtime,
+                                   "digest": file_digest(full_path)}
+                except (IOError, OSError) as e:
+                    _logger.warning("Sync scan: %s, Path: %s", e, full_path)
+        with self.lock:
+            self.files = files
+        return files
+
+    def update(self, path, digest):
+        full_path = os.path.join(self.root, path)
+        with self.lock:
+            if digest is None:
+                self.files.pop(path, None)
+                self.base.pop(path, None)
+                return
+            self.base[path] = digest
+            if os.path.exists(full_path):
+                stat = os.stat(full_path)
+                self.files[path] = {"size": stat.st_size,
+                                    "mtime": stat.st_mtime,
+                                    "digest": digest}
+
+    def save(self):
+        with self.lock:
+            state = {"files": self.files, "base": self.base}
+        temp_path = self.path + ".tmp"
+        with io.open(temp_path, "w") as f:
+            f.write(json.dumps(state, ensure_ascii=False))
+        os.rename(temp_path, self.path)
+
+
+class SyncEngine:
+    # Two-way sync of the uploads folder with the cloud library. Files are
+    # compared against the digest they had at the last sync, so each side's
+    # changes and deletions are told apart; when both sides changed a file
+    # the newer one wins. Changed files only move the blocks which differ
+    # and up to streams transfers run at once.
+    def __init__(self, root, state_dir, url, make_headers, install, remove,
+                 done=None, streams=3, interval=0, shaper=None):
+        self.root = root
+        self.shaper = shaper
+        self.state_dir = state_dir
+        self.url = url
+        self.make_headers = make_headers
+        self.install = install
+        self.remove = remove
+        self.done = done
+        self.streams = max(1, streams)
+        self.interval = interval
+        self.running = False
+        self.busy = threading.Lock()
+        self.lock = threading.Lock()
+        self.scanner = None
+        if hasattr(multiprocessing, "get_context"):
+            self.context = multiprocessing.get_context("spawn")
+        else:
+            self.context = multiprocessing
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+        self.manifest = Manifest(root, os.path.join(state_dir, "manifest.json"))
+
+    def start(self):
+        self.running = True
+        if self.interval > 0:
+            thread = threading.Thread(target=self.loop)
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def loop(self):
+        while self.running:
+            time.sleep(self.interval)
+            if self.running:
+                self.run()
+
+    def request(self, endpoint, method="get", headers=None, **kwargs):
+        all_headers = self.make_headers()
+        all_headers.update(headers or {})
+        resp = requests.request(method, self.url + endpoint,
+                                headers=all_headers, timeout=60, **kwargs)
+        resp.raise_for_status()
+        return resp
+
+    def cloud_manifest(self):
+        files = {}
+        for entry in self.request("manifest/").json().get("files", []):
+            files[safe_path(entry["path"])] = entry
+        return files
+
+    def plan(self, local, cloud):
+        actions = []
+        base = self.manifest.base
+        for path in sorted(set(local) | set(cloud) | set(base)):
+            local_digest = local[path]["digest"] if path in local else None
+            cloud_digest = cloud[path]["digest"] if path in cloud else None
+            if local_digest == cloud_digest:
+                self.manifest.update(path, local_digest)
+                continue
+            local_changed = local_digest != base.get(path)
+            cloud_changed = cloud_digest != base.get(path)
+            conflict = local_changed and cloud_changed
+            if conflict:
+                local_mtime = local[path]["mtime"] if path in local else 0
+                cloud_mtime = cloud[path].get("mtime", 0) if path in cloud else 0
+                local_changed = local_mtime >= cloud_mtime
+            if local_changed:
+                action = "upload" if local_digest else "delete_remote"
+            else:
+                action = "download" if cloud_digest else "delete_local"
+            actions.append((action, path, conflict))
+        return actions
+
+    def upload(self, path, summary):
+        full_path = os.path.join(self.root, path)
+        digest = self.manifest.files[path]["digest"]
+        try:
+            signature = self.request("signature/", params={"path": path}).json()
+            block_size = signature["block_size"]
+            sums = signature["signatures"]
+            base_digest = signature.get("digest")
+        except requests.exceptions.HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            block_size = block_size_for(os.path.getsize(full_path))
+            sums = []
+            base_digest = None
+        if sums:
+            # The rolling checksum scan is CPU bound pure Python, it runs in
+            # a low priority process to keep it off OctoPrint's GIL.
+            ops, literal_bytes = self.scan_pool().apply(
+                build_delta, (full_path, block_size, sums))
+        else:
+            ops, literal_bytes = build_delta(full_path, block_size, sums)
+        fields = {
+            "path": path,
+            "base_digest": base_digest,
+            "digest": digest,
+            "size": os.path.getsize(full_path),
+            "mtime": os.path.getmtime(full_path),
+            "block_size": block_size,
+        }
+        held = [0]
+        started = time.time()
+        self.request("patch/", method="post",
+                     data=delta_body(fields, full_path, ops, self.shaper, held),
+                     headers={"Content-Type": "application/json"})
+        if self.shaper is not None:
+            self.shaper.observe(literal_bytes,
+                                time.time() - started - held[0])
+        summary["bytes_sent"] += literal_bytes
+        self.manifest.update(path, digest)
+
+    def download(self, path, entry, summary):
+        full_path = os.path.join(self.root, path)
+        if not os.path.exists(full_path):
+            full_path = None
+        block_size = block_size_for(entry.get("size", 0))
+        resp = self.request("delta/", method="post", json={
+            "path": path,
+            "block_size": block_size,
+            "signatures": signatures(full_path, block_size),
+        }, stream=True)
+        handle, temp_path = tempfile.mkstemp(dir=self.state_dir)
+        os.close(handle)
+        try:
+            # The ops are patched in as they arrive, never held whole.
+            try:
+                if self.shaper is not None:
+                    chunks = shaped_chunks(resp, self.shaper)
+                else:
+                    chunks = resp.iter_content(16384)
+                summary["bytes_received"] += patch(
+                    full_path, block_size, OpStream(chunks).ops(), temp_path)
+            finally:
+                resp.close()
+            if file_digest(temp_path) != entry["digest"]:
+                raise ValueError("Digest mismatch after patching")
+            self.install(path, temp_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self.manifest.update(path, entry["digest"])
+
+    def scan_pool(self):
+        with self.lock:
+            if self.scanner is None:
+                self.scanner = self.context.Pool(1, initializer=lower_priority)
+            return self.scanner
+
+    def close_pool(self):
+        with self.lock:
+            scanner, self.scanner = self.scanner, None
+        if scanner is not None:
+            scanner.close()
+            scanner.join()
+
+    def transfer(self, action, path, cloud, summary):
+        if action == "upload":
+            self.upload(path, summary)
+        elif action == "download":
+            self.download(path, cloud[path], summary)
+        elif action == "delete_remote":
+            self.request("delete/", method="post", json={"path": path})
+            self.manifest.update(path, None)
+        else:
+            self.remove(path)
+            self.manifest.update(path, None)
+
+    def run(self):
+        # Returns the summary of the sync, or None when one is already running.
+        if not self.busy.acquire(False):
+            return None
+        try:
+            started = time.time()
+            summary = {"upload": [], "download": [], "delete_remote": [],
+                       "delete_local": [], "conflicts": [], "failed": [],
+                       "bytes_sent": 0, "bytes_received": 0}
+            try:
+                cloud = self.cloud_manifest()
+                local = self.manifest.scan()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                _logger.warning("Sync manifest: %s, URL: %s", e, self.url)
+                return None
+            tasks = queue.Queue()
+            for action, path, conflict in self.plan(local, cloud):
+                tasks.put((action, path))
+                if conflict:
+                    summary["conflicts"].append(path)
+            lock = threading.Lock()
+
+            def worker():
+                while True:
+                    try:
+                        action, path = tasks.get_nowait()
+                    except queue.Empty:
+                        return
+                    stats = {"bytes_sent": 0, "bytes_received": 0}
+                    try:
+                        self.transfer(action, path, cloud, stats)
+                        result = action
+                    except Exception as e:
+                        _logger.warning("Sync %s: %s, Path: %s", action, e, path)
+                        result = "failed"
+                    with lock:
+                        summary[result].append(path)
+                        for key, value in stats.items():
+                            summary[key] += value
+
+            threads = [threading.Thread(target=worker)
+                       for _ in range(min(self.streams, tasks.qsize()))]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.manifest.save()
+            summary["duration"] = round(time.time() - started, 3)
+            if self.done is not None:
+                self.done(summary)
+            return summary
+        finally:
+            self.close_pool()
+            self.busy.release()
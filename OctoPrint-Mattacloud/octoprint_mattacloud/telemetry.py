@@ -0,0 +1,148 @@
+from __future__ import absolute_import, unicode_literals, division, print_function
+import collections
+import logging
+import numbers
+import threading
+import time
+
+_logger = logging.getLogger("octoprint.plugins.mattacloud")
+
+
+def changed(old, new, deadband=0.0, ignore=()):
+    # Numbers only count as changed once they move by more than the
+    # deadband, everything else on any difference.
+    if isinstance(old, dict) and isinstance(new, dict):
+        keys = set(old) | set(new)
+        return any(changed(old.get(key), new.get(key), deadband, ignore)
+                   for key in keys if key not in ignore)
+    if isinstance(old, (list, tuple)) and isinstance(new, (list, tuple)):
+        if len(old) != len(new):
+            return True
+        return any(changed(o, n, deadband, ignore) for o, n in zip(old, new))
+    if (isinstance(old, numbers.Number) and isinstance(new, numbers.Number) and
+            not isinstance(old, bool) and not isinstance(new, bool)):
+        return abs(new - old) > deadband
+    return old != new
+
+
+class Topic:
+    def __init__(self, name, getter, min_interval=1.0, poll_interval=None,
+                 deadband=0.0, ignore=(), urgent=()):
+        self.name = name
+        self.getter = getter
+        self.min_interval = min_interval
+        if poll_interval is None:
+            poll_interval = min_interval
+        self.poll_interval = poll_interval
+        self.deadband = deadband
+        self.ignore = ignore
+        self.urgent = urgent
+        self.subscribed = True
+        self.requested_interval = None
+        self.last_value = None
+        self.last_sent = 0
+        self.last_polled = 0
+        self.dirty = True
+
+    def interval(self, floor):
+        if self.requested_interval is not None:
+            return max(self.requested_interval, floor)
+        return max(self.min_interval, floor)
+
+    def is_urgent(self, value):
+        if not isinstance(value, dict) or not isinstance(self.last_value, dict):
+            return False
+        return any(value.get(key) != self.last_value.get(key)
+                   for key in self.urgent)
+
+
+class RateController:
+    def __init__(self, keepalive=300):
+        self.keepalive = keepalive
+        self.topics = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, topic):
+        self.topics[topic.name] = topic
+
+    def subscribe(self, subscriptions):
+        # Subscriptions map a topic to the max rate (Hz) the cloud wants it
+        # at, 0 unsubscribes and None reverts to the local default.
+        with self.lock:
+            for name, rate in subscriptions.items():
+                topic = self.topics.get(name)
+                if topic is None:
+                    _logger.warning("Unknown telemetry topic: %s", name)
+                    continue
+                if rate is None:
+                    topic.subscribed = True
+                    topic.requested_interval = None
+                elif rate <= 0:
+                    topic.subscribed = False
+                else:
+                    topic.subscribed = True
+                    topic.requested_interval = 1.0 / rate
+                topic.dirty = True
+
+    def invalidate(self, name):
+        with self.lock:
+            if name in self.topics:
+                self.topics[name].dirty = True
+
+    def recheck(self, name):
+        # Polls the topic at the next chance, it goes out only if changed.
+        with self.lock:
+            if name in self.topics:
+                self.topics[name].last_polled = 0
+
+    def sent(self, name, value, now=None):
+        # Records a value of the topic which went out in another message.
+        with self.lock:
+            topic = self.topics.get(name)
+            if topic is not None:
+                topic.last_value = value
+                topic.last_sent = now if now is not None else time.time()
+                topic.last_polled = topic.last_sent
+                topic.dirty = False
+
+    def reset(self):
+        with self.lock:
+            for topic in self.topics.values():
+                topic.last_value = None
+                topic.dirty = True
+
+    def poll(self, floor=0.0, now=None):
+        # Returns the topics which are due to be sent, keyed by name. A topic
+        # goes out when it has changed beyond its deadband and its interval
+        # has elapsed, when it is dirty or stale, or at once when one of its
+        # urgent keys changes.
+        if now is None:
+            now = time.time()
+        due = {}
+        with self.lock:
+            for topic in self.topics.values():
+                if not topic.subscribed:
+                    continue
+                since_sent = now - topic.last_sent
+                stale = since_sent >= self.keepalive
+                if not (topic.dirty or stale or
+                        (now - topic.last_polled) >= topic.poll_interval):
+                    continue
+                ready = (stale or topic.last_value is None or
+                         since_sent >= topic.interval(floor))
+                if not ready and not topic.urgent:
+                    continue
+                topic.last_polled = now
+                value = topic.getter()
+                if ready:
+                    send = (topic.dirty or stale or topic.last_value is None or
+                            changed(topic.last_value, value,
+                                    topic.deadband, topic.ignore))
+                else:
+                    send = topic.is_urgent(value)
+                if send:
+                    due[topic.name] = value
+                    topic.last_value = value
+                    topic.last_sent = now
+                    topic.dirty = False
+        return due
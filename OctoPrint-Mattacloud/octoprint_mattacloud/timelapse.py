@@ -0,0 +1,239 @@
+from __future__ import absolute_import, unicode_literals, division, print_function
+import glob
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+import zipfile
+
+import requests
+
+from .backoff import BackoffTime
+from .shaper import ShapedReader
+
+_logger = logging.getLogger("octoprint.plugins.mattacloud")
+
+
+class JobStore:
+    # Frames of one job on disk. When the store outgrows its limits every
+    # other frame of each camera is deleted and only every other new frame
+    # is kept, so the archive always spans the whole job at a lower rate.
+    # Cameras are counted apart, they may take turns.
+    def __init__(self, path, max_frames, max_bytes):
+        self.path = path
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.frames = {}
+        self.bytes = 0
+        self.stride = {}
+        self.seen = {}
+        self.lock = threading.Lock()
+        os.makedirs(self.path)
+
+    def count(self):
+        with self.lock:
+            return sum(len(frames) for frames in self.frames.values())
+
+    def add(self, camera, data):
+        with self.lock:
+            seen = self.seen[camera] = self.seen.get(camera, 0) + 1
+            if seen % self.stride.setdefault(camera, 1):
+                return
+            name = os.path.join(self.path,
+                                "cam{}-{:06d}.jpg".format(camera, seen))
+            with io.open(name, "wb") as frame:
+                frame.write(data)
+            self.frames.setdefault(camera, []).append((name, len(data)))
+            self.bytes += len(data)
+            count = sum(len(frames) for frames in self.frames.values())
+            if count > self.max_frames or self.bytes > self.max_bytes:
+                for each in self.frames:
+                    self.thin(each)
+
+    def thin(self, camera):
+        kept = []
+        for index, (name, size) in enumerate(self.frames[camera]):
+            if index % 2:
+                os.remove(name)
+                self.bytes -= size
+            else:
+                kept.append((name, size))
+        self.frames[camera] = kept
+        self.stride[camera] *= 2
+
+
+def encode(path, output, ffmpeg=None, fps=25):
+    # Runs in a separate, low priority process at the end of a job. The video
+    # is made from the primary camera's frames.
+    try:
+        os.nice(19)
+    except (AttributeError, OSError):
+        pass
+    if ffmpeg:
+        command = [ffmpeg, "-y", "-loglevel", "error",
+                   "-framerate", str(fps), "-pattern_type", "glob",
+                   "-i", os.path.join(path, "cam1-*.jpg"),
+                   "-c:v", "libx264", "-preset", "slow", "-crf", "28",
+                   "-pix_fmt", "yuv420p", output]
+        if subprocess.call(command) == 0:
+            return
+        if os.path.exists(output):
+            os.remove(output)
+    # JPEGs do not compress any further, so the frames are only stored.
+    output = os.path.splitext(output)[0] + ".zip"
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_STORED) as archive:
+        for name in sorted(os.listdir(path)):
+            archive.write(os.path.join(path, name), name)
+
+
+class ResumableUpload:
+    # Uploads a file in chunks with Content-Range headers. The server reports
+    # how much of an upload it already holds, so an interrupted upload
+    # carries on where it stopped, even after a restart. make_headers is
+    # called for every request so a new token is picked up.
+    def __init__(self, url, make_headers, path, metadata, chunk_size=1048576,
+                 max_attempts=10, shaper=None):
+        self.url = url
+        self.shaper = shaper
+        self.make_headers = make_headers
+        self.path = path
+        self.metadata = metadata
+        self.chunk_size = chunk_size
+        self.max_attempts = max_attempts
+        self.size = os.path.getsize(path)
+        self.upload_id = hashlib.sha1("{}:{}".format(
+            os.path.basename(path), self.size).encode("utf-8")).hexdigest()
+
+    def offset(self):
+        resp = requests.get(self.url, params={"upload_id": self.upload_id},
+                            headers=self.make_headers())
+        if resp.status_code == 404:
+            return 0
+        resp.raise_for_status()
+        return int(resp.json().get("offset", 0))
+
+    def run(self):
+        backoff = BackoffTime(max_time=300)
+        while backoff.attempt < self.max_attempts:
+            try:
+                offset = self.offset()
+                while offset < self.size:
+                    with io.open(self.path, "rb") as upload:
+                        upload.seek(offset)
+                        chunk = upload.read(self.chunk_size)
+                    headers = self.make_headers()
+                    headers.update({
+                        "Content-Type": "application/octet-stream",
+                        "Content-Range": "bytes {}-{}/{}".format(
+                            offset, offset + len(chunk) - 1, self.size),
+                    })
+                    params = dict(self.metadata)
+                    params["upload_id"] = self.upload_id
+                    params["filename"] = os.path.basename(self.path)
+                    data = chunk
+                    if self.shaper is not None:
+                        data = ShapedReader(io.BytesIO(chunk), self.shaper,
+                                            length=len(chunk))
+                    resp = requests.put(self.url, data=data, params=params,
+                                        headers=headers)
+                    resp.raise_for_status()
+                    offset += len(chunk)
+                    backoff.zero()
+                return True
+            except requests.exceptions.RequestException as e:
+                _logger.warning("Timelapse upload: %s, Path: %s", e, self.path)
+                backoff.longer()
+        return False
+
+
+class TimelapseArchiver:
+    def __init__(self, root, url, make_headers, ffmpeg=None, fps=25,
+                 max_frames=3000, max_bytes=524288000, shaper=None):
+        self.root = root
+        self.shaper = shaper
+        self.url = url
+        self.make_headers = make_headers
+        self.ffmpeg = ffmpeg
+        self.fps = fps
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.store = None
+        self.job = None
+        if hasattr(multiprocessing, "get_context"):
+            self.context = multiprocessing.get_context("spawn")
+        else:
+            self.context = multiprocessing
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+    def start_job(self, job_name):
+        if self.store is not None:
+            self.finish(success=False)
+        safe_name = re.sub(r"[^\w.-]", "_", os.path.splitext(job_name)[0])
+        path = os.path.join(self.root, "{}-{}".format(safe_name, int(time.time())))
+        self.job = job_name
+        self.store = JobStore(path, self.max_frames, self.max_bytes)
+
+    def add(self, camera, data):
+        # finish() may take the store away from another thread.
+        store = self.store
+        if store is not None:
+            try:
+                store.add(camera, data)
+            except (IOError, OSError) as e:
+                _logger.warning("Timelapse frame: %s", e)
+
+    def finish(self, success):
+        store, self.store = self.store, None
+        if store is None:
+            return
+        metadata = {
+            "job": self.job,
+            "success": success,
+            "frames": store.count(),
+        }
+        thread = threading.Thread(target=self.archive, args=(store.path, metadata))
+        thread.daemon = True
+        thread.start()
+
+    def archive(self, path, metadata):
+        if os.listdir(path):
+            process = self.context.Process(
+                target=encode, args=(path, path + ".mp4", self.ffmpeg, self.fps))
+            process.start()
+            process.join()
+            for output in (path + ".mp4", path + ".zip"):
+                if os.path.exists(output):
+                    with io.open(path + ".json", "w") as manifest:
+                        manifest.write(json.dumps(metadata, ensure_ascii=False))
+                    self.upload(output)
+                    break
+        shutil.rmtree(path, ignore_errors=True)
+
+    def upload(self, output):
+        manifest = os.path.splitext(output)[0] + ".json"
+        with io.open(manifest) as sidecar:
+            metadata = json.load(sidecar)
+        upload = ResumableUpload(self.url, self.make_headers, output, metadata,
+                                 shaper=self.shaper)
+        if upload.run():
+            os.remove(output)
+            os.remove(manifest)
+
+    def resume(self):
+        # Archives left over from before a restart are uploaded again.
+        for manifest in glob.glob(os.path.join(self.root, "*.json")):
+            base = os.path.splitext(manifest)[0]
+            for output in (base + ".mp4", base + ".zip"):
+                if os.path.exists(output):
+                    thread = threading.Thread(target=self.upload, args=(output,))
+                    thread.daemon = True
+                    thread.start()
+                    break
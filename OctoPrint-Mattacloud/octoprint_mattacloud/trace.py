@@ -0,0 +1,227 @@
+from __future__ import absolute_import, unicode_literals, division, print_function
+import collections
+import logging
+import threading
+import time
+
+from .link import LatencyHistogram
+
+_logger = logging.getLogger("octoprint.plugins.mattacloud")
+
+# Commands which are confirmed by an OctoPrint event.
+EVENTS = {
+    "pause": ("PrintPaused",),
+    "resume": ("PrintResumed",),
+    "toggle": ("PrintPaused", "PrintResumed"),
+    "cancel": ("PrintCancelled",),
+    "print": ("PrintStarted",),
+    "select": ("FileSelected",),
+}
+
+# Commands which are confirmed by the firmware's ok for the first line they
+# send, the rest of them are done once handle_cmds returns. Their lines are
+# tagged with the cids, see tags().
+SERIAL = frozenset(["home", "jog", "extrude", "retract", "change_tool",
+                    "feed_rate", "flow_rate", "gcode", "temperature",
+                    "z_adjust"])
+
+STAGES = ("delivery", "queue", "dispatch", "serial", "printer")
+
+TAG_PREFIX = "plugin:mattacloud:cid:"
+
+
+def tags(cids):
+    # OctoPrint tags for the lines a command sends, handed back by the
+    # gcode.sent hook.
+    return set(TAG_PREFIX + "{}".format(cid) for cid in cids)
+
+
+def tagged_cids(tags):
+    return [tag[len(TAG_PREFIX):] for tag in tags
+            if tag.startswith(TAG_PREFIX)]
+
+
+class Span:
+    def __init__(self, cid, cmd, sent_at=None):
+        self.cid = cid
+        self.cmd = cmd
+        self.sent_at = sent_at
+        self.received = time.time()
+        self.started = None
+        self.dispatched = None
+        self.line_sent = None
+        self.closed = None
+        self.waiting = ()
+        self.status = "ok"
+
+    def stages(self):
+        stages = {}
+        if self.sent_at is not None:
+            stages["delivery"] = max(0.0, self.received - self.sent_at)
+        if self.started is not None:
+            stages["queue"] = self.started - self.received
+        if self.dispatched is not None:
+            stages["dispatch"] = self.dispatched - self.started
+            if self.line_sent is None:
+                stages["printer"] = self.closed - self.dispatched
+            elif self.line_sent > self.dispatched:
+                stages["serial"] = self.line_sent - self.dispatched
+        if self.line_sent is not None:
+            stages["printer"] = self.closed - self.line_sent
+        return stages
+
+
+class CommandTracer:
+    # Follows cloud commands which carry a correlation ID (cid) from the
+    # websocket through handle_cmds to the event or serial response which
+    # confirms them. Serial commands wait for their first line to go to the
+    # printer and are confirmed by the next ok, OctoPrint only sends a line
+    # once the one before it has been acknowledged. Finished spans are kept
+    # in per stage and per command histograms and queued, flush() reports
+    # them through send from the caller's thread, never the serial ones.
+    def __init__(self, send, timeout=30, window=200):
+        self.send = send
+        self.timeout = timeout
+        self.window = window
+        self.spans = collections.OrderedDict()
+        self.serial = collections.deque()
+        self.finished = collections.deque(maxlen=window)
+        self.stages = dict((stage, LatencyHistogram(window)) for stage in STAGES)
+        self.totals = {}
+        self.timeouts = 0
+        self.lock = threading.Lock()
+
+    def received(self, json_msg):
+        cid = json_msg.get("cid")
+        if cid is None:
+            return
+        try:
+            sent_at = float(json_msg["sent_at"])
+        except (KeyError, TypeError, ValueError):
+            sent_at = None
+        with self.lock:
+            self.spans[cid] = Span(cid, json_msg["cmd"].lower(), sent_at)
+
+    def dispatching(self, cids):
+        now = time.time()
+        with self.lock:
+            for cid in cids:
+                if cid in self.spans:
+                    self.spans[cid].started = now
+
+    def dispatched(self, cids, error=None):
+        # Commands merged into one dispatch share the ok which confirms it.
+        now = time.time()
+        finished = []
+        with self.lock:
+            for cid in cids:
+                span = self.spans.get(cid)
+                if span is None:
+                    continue
+                span.dispatched = now
+                if error is not None:
+                    span.status = "error"
+                elif span.cmd in EVENTS:
+                    span.waiting = EVENTS[span.cmd]
+                    continue
+                elif span.cmd in SERIAL:
+                    # The line may already be out, see sent().
+                    if span.line_sent is None:
+                        span.waiting = ("sent",)
+                    continue
+                finished.append(self.close(cid, now))
+        self.report(finished)
+
+    def sent(self, tags):
+        # Called for every line sent to the printer, so it returns early
+        # unless the line is tagged with a cid.
+        if not tags or not self.spans:
+            return
+        tagged = set(tagged_cids(tags))
+        if not tagged:
+            return
+        now = time.time()
+        with self.lock:
+            serial = []
+            for cid, span in self.spans.items():
+                if span.line_sent is not None or "{}".format(cid) not in tagged:
+                    continue
+                span.line_sent = now
+                span.waiting = ("ok",)
+                serial.append(cid)
+            if serial:
+                self.serial.append(serial)
+
+    def event(self, event):
+        now = time.time()
+        with self.lock:
+            cids = [cid for cid, span in self.spans.items()
+                    if event in span.waiting]
+            finished = [self.close(cid, now) for cid in cids]
+        self.report(finished)
+
+    def line(self, line):
+        # Called for every line from the printer, so it returns early unless
+        # a command is waiting for an ok.
+        if not self.serial or not line.startswith("ok"):
+            return
+        now = time.time()
+        with self.lock:
+            finished = []
+            while self.serial and not finished:
+                finished = [self.close(cid, now) for cid in self.serial.popleft()
+                            if cid in self.spans]
+        self.report(finished)
+
+    def expire(self):
+        now = time.time()
+        with self.lock:
+            cids = [cid for cid, span in self.spans.items()
+                    if now - span.received > self.timeout]
+            finished = []
+            for cid in cids:
+                self.spans[cid].status = "timeout"
+                finished.append(self.close(cid, now))
+                self.timeouts += 1
+        self.report(finished)
+
+    def close(self, cid, now):
+        span = self.spans.pop(cid)
+        span.closed = now
+        return span
+
+    def report(self, spans):
+        self.finished.extend(spans)
+
+    def flush(self):
+        while self.finished:
+            span = self.finished.popleft()
+            stages = span.stages()
+            total = sum(stages.values())
+            if span.status == "ok":
+                for stage, duration in stages.items():
+                    self.stages[stage].add(duration)
+                if span.cmd not in self.totals:
+                    self.totals[span.cmd] = LatencyHistogram(self.window)
+                self.totals[span.cmd].add(total)
+            try:
+                self.send({
+                    "cid": span.cid,
+                    "cmd": span.cmd,
+                    "status": span.status,
+                    "stages": dict((stage, round(duration * 1000.0, 1))
+                                   for stage, duration in stages.items()),
+                    "total": round(total * 1000.0, 1),
+                })
+            except Exception as e:
+                _logger.error("Command trace %s: %s", span.cid, e)
+
+    def stats(self):
+        return {
+            "stages": dict((stage, histogram.summary())
+                           for stage, histogram in self.stages.items()),
+            "commands": dict((cmd, histogram.summary())
+                             for cmd, histogram in list(self.totals.items())),
+            "pending": len(self.spans),
+            "timeouts": self.timeouts,
+        }
@@ -0,0 +1,241 @@
+from __future__ import absolute_import, unicode_literals, division, print_function
+import io
+import logging
+import select
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_logger = logging.getLogger("octoprint.plugins.mattacloud")
+
+
+def parse_sample(line):
+    # Samples arrive one per line as "x,y,z" accelerations.
+    if isinstance(line, bytes):
+        line = line.decode("ascii", "ignore")
+    parts = line.strip().split(",")
+    if len(parts) != 3:
+        return None
+    try:
+        return float(parts[0]), float(parts[1]), float(parts[2])
+    except ValueError:
+        return None
+
+
+class Source:
+    # Sources never block for longer than poll seconds, so once closed the
+    # reader lets go of the device within that time.
+    poll = 0.5
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class SerialSource(Source):
+    def __init__(self, port, baudrate=115200):
+        Source.__init__(self)
+        self.port = port
+        self.baudrate = baudrate
+
+    def lines(self):
+        import serial
+        with serial.Serial(self.port, self.baudrate,
+                           timeout=self.poll) as conn:
+            while not self.closed:
+                line = conn.readline()
+                if line:
+                    yield line
+
+
+class DeviceSource(Source):
+    def __init__(self, path):
+        Source.__init__(self)
+        self.path = path
+
+    def lines(self):
+        with io.open(self.path, "rb", buffering=0) as device:
+            pending = b""
+            while not self.closed:
+                readable, _, _ = select.select([device], [], [], self.poll)
+                if not readable:
+                    continue
+                data = device.read(4096)
+                if not data:
+                    break
+                pending += data
+                lines = pending.split(b"\n")
+                pending = lines.pop()
+                for line in lines:
+                    yield line + b"\n"
+
+
+class ReplaySource(Source):
+    # Replays a recorded capture at the configured sample rate, for testing
+    # without a sensor attached.
+    def __init__(self, path, sample_rate):
+        Source.__init__(self)
+        self.path = path
+        self.sample_rate = sample_rate
+
+    def lines(self):
+        chunk = max(1, int(self.sample_rate / 100))
+        while not self.closed:
+            with io.open(self.path, "rb") as capture:
+                for count, line in enumerate(capture, 1):
+                    if self.closed:
+                        return
+                    yield line
+                    if count % chunk == 0:
+                        time.sleep(chunk / self.sample_rate)
+
+
+def make_source(uri, sample_rate):
+    # "serial:/dev/ttyUSB0:115200", "replay:/path/to/capture.csv" or the
+    # path of a character device.
+    if uri.startswith("serial:"):
+        port = uri[len("serial:"):]
+        path, _, baudrate = port.rpartition(":")
+        if path and baudrate.isdigit():
+            return SerialSource(path, int(baudrate))
+        return SerialSource(port)
+    if uri.startswith("replay:"):
+        return ReplaySource(uri[len("replay:"):], sample_rate)
+    return DeviceSource(uri)
+
+
+class RingBuffer:
+    def __init__(self, capacity, channels=3):
+        self.data = np.zeros((capacity, channels), dtype=np.float32)
+        self.capacity = capacity
+        self.index = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def write(self, samples):
+        n = len(samples)
+        if n > self.capacity:
+            samples = samples[-self.capacity:]
+            n = self.capacity
+        with self.lock:
+            end = self.index + n
+            if end <= self.capacity:
+                self.data[self.index:end] = samples
+            else:
+                first = self.capacity - self.index
+                self.data[self.index:] = samples[:first]
+                self.data[:n - first] = samples[first:]
+            self.index = end % self.capacity
+            self.count = min(self.count + n, self.capacity)
+
+    def latest(self, n):
+        with self.lock:
+            n = min(n, self.count)
+            start = (self.index - n) % self.capacity
+            if start + n <= self.capacity:
+                return self.data[start:start + n].copy()
+            return np.concatenate((self.data[start:], self.data[:self.index]))
+
+
+def extract_features(samples, sample_rate, bands):
+    samples = samples - samples.mean(axis=0)
+    rms = np.sqrt(np.mean(samples ** 2, axis=0))
+    window = np.hanning(len(samples))[:, np.newaxis]
+    power = np.abs(np.fft.rfft(samples * window, axis=0)) ** 2
+    power /= len(samples)
+    freqs = np.fft.rfftfreq(len(samples), d=1.0 / sample_rate)
+    energy = []
+    for low, high in bands:
+        mask = (freqs >= low) & (freqs < high)
+        energy.append([round(float(e), 6) for e in power[mask].sum(axis=0)])
+    peaks = freqs[np.argmax(power[1:], axis=0) + 1]
+    return {
+        "sample_rate": sample_rate,
+        "samples": len(samples),
+        "rms": [round(float(r), 6) for r in rms],
+        "peak_hz": [round(float(p), 2) for p in peaks],
+        "bands": [list(band) for band in bands],
+        "energy": energy,
+    }
+
+
+class VibrationMonitor:
+    def __init__(self, source, send, sample_rate=800, window=1024,
+                 interval=10, bands=((0, 10), (10, 50), (50, 100),
+                                     (100, 200), (200, 400))):
+        self.source = source
+        self.send = send
+        self.sample_rate = sample_rate
+        self.window = window
+        self.interval = interval
+        self.bands = bands
+        self.buffer = RingBuffer(capacity=window * 2)
+        self.running = False
+        self.reader = None
+
+    @staticmethod
+    def available():
+        return np is not None
+
+    def start(self):
+        self.running = True
+        self.reader = threading.Thread(target=self.read)
+        loop = threading.Thread(target=self.loop)
+        for thread in (self.reader, loop):
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        # Waits for the reader to close the source, so a new monitor can
+        # open the same device right away.
+        self.running = False
+        self.source.close()
+        if self.reader is not None:
+            self.reader.join(self.source.poll * 4)
+            self.reader = None
+
+    def read(self):
+        chunk = np.empty((64, 3), dtype=np.float32)
+        filled = 0
+        while self.running:
+            lines = self.source.lines()
+            try:
+                for line in lines:
+                    if not self.running:
+                        break
+                    sample = parse_sample(line)
+                    if sample is None:
+                        continue
+                    chunk[filled] = sample
+                    filled += 1
+                    if filled == len(chunk):
+                        self.buffer.write(chunk)
+                        filled = 0
+            except (IOError, OSError) as e:
+                _logger.error("Vibration source: %s", e)
+            except ImportError as e:
+                _logger.error("Vibration source unavailable: %s", e)
+                self.running = False
+                return
+            finally:
+                lines.close()
+            if self.running:
+                time.sleep(1)
+
+    def loop(self):
+        while self.running:
+            time.sleep(self.interval)
+            samples = self.buffer.latest(self.window)
+            if len(samples) < self.window:
+                continue
+            try:
+                self.send(extract_features(samples, self.sample_rate,
+                                           self.bands))
+            except Exception as e:
+                _logger.error("Vibration features: %s", e)
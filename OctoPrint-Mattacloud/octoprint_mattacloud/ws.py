@@ -1,17 +1,93 @@
 from __future__ import absolute_import, unicode_literals, division, print_function
+import collections
+import itertools
 import json
 import logging
+import struct
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import websocket
 
+from .link import LinkMonitor
+from .shaper import CONTROL, SNAPSHOT, TELEMETRY
+
 _logger = logging.getLogger("octoprint.plugins.mattacloud")
 
+# Header of a binary image frame: version, camera, chunk index, chunk count,
+# sequence number, capture timestamp and the length of the job name which
+# follows the header, before the JPEG payload.
+IMAGE_HEADER = struct.Struct("!BBHHIdH")
+IMAGE_VERSION = 1
+
+
+def pack_image_frames(camera, job, seq, timestamp, data, chunk_size=16384):
+    job = (job or "").encode("utf-8")
+    chunks = [data[i:i + chunk_size]
+              for i in range(0, len(data), chunk_size)] or [b""]
+    frames = []
+    for index, chunk in enumerate(chunks):
+        header = IMAGE_HEADER.pack(IMAGE_VERSION, camera, index, len(chunks),
+                                   seq, timestamp, len(job))
+        frames.append(header + job + chunk)
+    return frames
+
+
+class Inbox:
+    # Runs handle on received messages in order on a thread of its own, so
+    # the thread reading the socket only reads. A slow handler, e.g. a file
+    # download, then never holds up pongs and looks like a dead link.
+    def __init__(self, handle):
+        self.handle = handle
+        self.messages = queue.Queue()
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def put(self, ws, msg):
+        self.messages.put((ws, msg))
+
+    def run(self):
+        while True:
+            ws, msg = self.messages.get()
+            try:
+                self.handle(ws, msg)
+            except Exception as e:
+                _logger.error("Handling message: %s", e)
+
 
 class Socket():
-    def __init__(self, on_open, on_message, on_close, on_error, url, token):
+    def __init__(self, on_open, on_message, on_close, on_error, url, token,
+                 link=None, heartbeat_interval=2, max_image_bytes=1048576,
+                 shaper=None, max_queue=1000):
+        self.link = link if link is not None else LinkMonitor()
+        self.shaper = shaper
+        # Text frames wait for the shaper on the sender thread, never on the
+        # caller's, which may be one of OctoPrint's. Higher classes go first.
+        self.outbox = queue.PriorityQueue()
+        self.max_queue = max_queue
+        self.order = itertools.count()
+        self.dropped = 0
+        self.heartbeat_interval = heartbeat_interval
+        self.running = False
+        self.is_open = False
+        self.images = collections.deque()
+        self.image_bytes = 0
+        self.max_image_bytes = max_image_bytes
+        self.image_lock = threading.Condition()
+        self.open_callback = on_open
+        self.message_callback = on_message
         self.socket = websocket.WebSocketApp(url,
-                                             on_open=on_open,
-                                             on_message=on_message,
+                                             on_open=self.on_open,
+                                             on_message=self.on_message,
+                                             on_pong=self.on_pong,
                                              on_close=on_close,
                                              on_error=on_error,
                                              header=[
@@ -19,6 +95,92 @@ class Socket():
                                              ]
                                              )
 
+    def on_open(self, ws):
+        # Frames go out from several threads at once, which websocket-client
+        # before 1.0 only allows when run_forever() pings itself.
+        lock = getattr(ws.sock, "lock", None)
+        if lock is not None and not hasattr(lock, "acquire"):
+            ws.sock.lock = threading.Lock()
+        self.is_open = True
+        self.link.opened()
+        self.open_callback(ws)
+
+    def on_message(self, ws, msg):
+        self.link.received()
+        try:
+            json_msg = json.loads(msg)
+        except ValueError:
+            json_msg = None
+        if isinstance(json_msg, dict):
+            if "ack" in json_msg:
+                self.link.acked(json_msg["ack"])
+            if "pong" in json_msg and "cmd" not in json_msg:
+                self.link.pong(json_msg["pong"])
+                return
+        self.message_callback(ws, msg)
+
+    def on_pong(self, ws, data):
+        if isinstance(data, bytes):
+            data = data.decode("utf-8", "ignore")
+        self.link.pong(data)
+
+    def heartbeat(self):
+        while self.running:
+            time.sleep(self.heartbeat_interval)
+            if not (self.is_open and self.socket.sock and
+                    self.socket.sock.connected):
+                continue
+            if self.link.is_dead():
+                _logger.warning("No response from the cloud for %ss, "
+                                "dropping the websocket.",
+                                self.link.dead_timeout)
+                self.disconnect()
+                return
+            try:
+                self.socket.sock.ping("{:.6f}".format(time.time()))
+            except Exception as e:
+                _logger.error("Socket heartbeat: %s", e)
+
+    def send_image(self, camera, job, seq, timestamp, data):
+        # Queues a snapshot to go out as binary frames. Returns False when the
+        # socket is down or too far behind, so the caller can fall back to
+        # the HTTP upload instead.
+        if not self.connected():
+            return False
+        with self.image_lock:
+            if self.image_bytes + len(data) > self.max_image_bytes:
+                return False
+            frames = pack_image_frames(camera, job, seq, timestamp, data)
+            self.images.extend(frames)
+            self.image_bytes += sum(len(frame) for frame in frames)
+            self.image_lock.notify()
+        return True
+
+    def queue_depth(self):
+        with self.image_lock:
+            return len(self.images) + self.outbox.qsize()
+
+    def send_images(self):
+        # Images are sent one chunk at a time from this thread, so text frames
+        # sent from other threads get onto the wire between the chunks.
+        while self.running:
+            with self.image_lock:
+                while self.running and not self.images:
+                    self.image_lock.wait(1.0)
+                if not self.running:
+                    break
+                frame = self.images.popleft()
+                self.image_bytes -= len(frame)
+            if self.shaper is not None:
+                self.shaper.acquire(len(frame), SNAPSHOT)
+            try:
+                self.socket.send(frame, opcode=websocket.ABNF.OPCODE_BINARY)
+            except Exception as e:
+                _logger.error("Socket send_images: %s", e)
+        with self.image_lock:
+            self.images.clear()
+            self.image_bytes = 0
+
     def on_error(self, error):
         # TODO: handle websocket errors
         _logger.error("Socket on_error: %s", error)
@@ -28,25 +190,59 @@ class Socket():
         _logger.info("Closing the websocket...")
         self.disconnect()
 
+    def send_frames(self):
+        while self.running:
+            try:
+                priority, _, msg = self.outbox.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            if not self.running:
+                break
+            try:
+                if isinstance(msg, dict):
+                    msg = json.dumps(self.link.sent(msg))
+                if self.shaper is not None:
+                    self.shaper.acquire(len(msg), priority)
+                if self.connected():
+                    self.socket.send(msg)
+            except Exception as e:
+                _logger.error("Socket send_frames: %s", e)
+            self.frame_sent()
+
+    def frame_sent(self):
+        pass
+
+    def backlog(self):
+        return self.outbox.qsize()
+
     def run(self):
+        self.running = True
+        for target in (self.heartbeat, self.send_images, self.send_frames):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
         try:
             self.socket.run_forever()
         except Exception as e:
             _logger.error("Socket run: %s", e)
             pass
 
-    def send_msg(self, msg):
-        try:
-            if isinstance(msg, dict):
-                msg = json.dumps(msg)
-            if self.connected() and self.socket is not None:
-                self.socket.send(msg)
-        except Exception as e:
-            _logger.error("Socket send_msg: %s", e)
-            pass
+    def send_msg(self, msg, priority=TELEMETRY):
+        # Queues a text frame, frames are numbered for the link monitor as
+        # they go out. When the queue is full only control frames are kept.
+        if priority is None:
+            priority = TELEMETRY
+        if priority == CONTROL or self.outbox.qsize() < self.max_queue:
+            self.outbox.put((priority, next(self.order), msg))
+        else:
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                _logger.warning("Websocket is not keeping up, %s frames "
+                                "dropped", self.dropped)
 
     def connected(self):
-        return self.socket.sock and self.socket.sock.connected
+        return (self.is_open and self.socket.sock and
+                self.socket.sock.connected and not self.link.is_dead())
 
     def connect(self, on_message, on_close, url, token):
         self.socket = websocket.WebSocketApp(url,
@@ -60,6 +256,10 @@ class Socket():
 
     def disconnect(self):
         _logger.info("Disconnecting the websocket...")
+        self.running = False
+        self.is_open = False
+        with self.image_lock:
+            self.image_lock.notify_all()
         self.socket.keep_running = False
         self.socket.close()
         _logger.info("The websocket has been closed.")
@@ -37,6 +37,8 @@ plugin_license = "AGPLv3"
 plugin_requires = [
     "ndg-httpsclient",
     "requests-toolbelt",
+    "websocket-client>=1.0; python_version>='3'",
+    "websocket-client; python_version<'3'",
 ]
 
 # --------------------------------------------------------------------------------------------------------------------
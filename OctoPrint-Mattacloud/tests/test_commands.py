@@ -0,0 +1,80 @@
+from __future__ import absolute_import, unicode_literals, division, print_function
+import unittest
+
+from octoprint_mattacloud.commands import CommandCoalescer
+
+
+class MergeTest(unittest.TestCase):
+    def setUp(self):
+        self.executed = []
+        self.coalescer = CommandCoalescer(execute=self.executed.append,
+                                          done=lambda: None, window=60)
+
+    def tearDown(self):
+        self.coalescer.flush()
+
+    def run_burst(self, *commands):
+        for cid, msg in enumerate(commands):
+            msg = dict(msg, cid=cid)
+            self.assertTrue(self.coalescer.submit(msg))
+        self.coalescer.flush()
+        return [(msg["cmd"], msg.get("axes", msg.get("amt")), msg["cids"])
+                for msg in self.executed]
+
+    def test_jogs_along_the_same_axes_add_up(self):
+        self.assertEqual(self.run_burst(
+            {"cmd": "jog", "axes": {"x": 1, "y": 2}},
+            {"cmd": "jog", "axes": {"x": 1, "y": 2}},
+        ), [("jog", {"x": 2, "y": 4}, [0, 1])])
+
+    def test_jogs_along_other_axes_stay_apart(self):
+        self.assertEqual(self.run_burst(
+            {"cmd": "jog", "axes": {"z": 10}},
+            {"cmd": "jog", "axes": {"x": 100}},
+        ), [("jog", {"z": 10}, [0]), ("jog", {"x": 100}, [1])])
+
+    def test_jogs_in_opposite_directions_stay_apart(self):
+        self.assertEqual(self.run_burst(
+            {"cmd": "jog", "axes": {"x": 5}},
+            {"cmd": "jog", "axes": {"x": -5}},
+        ), [("jog", {"x": 5}, [0]), ("jog", {"x": -5}, [1])])
+
+    def test_extrudes_add_up(self):
+        self.assertEqual(self.run_burst(
+            {"cmd": "extrude", "amt": 5},
+            {"cmd": "extrude", "amt": 5},
+        ), [("extrude", 10, [0, 1])])
+
+    def test_extrude_and_retract_stay_apart(self):
+        self.assertEqual(self.run_burst(
+            {"cmd": "extrude", "amt": 5},
+            {"cmd": "retract", "amt": 5},
+        ), [("extrude", 5, [0]), ("extrude", -5, [1])])
+
+    def test_gcode_concatenates(self):
+        self.assertEqual(self.run_burst(
+            {"cmd": "gcode", "commands": "G28"},
+            {"cmd": "gcode", "commands": ["M104 S200"]},
+        ), [("gcode", None, [0, 1])])
+        self.assertEqual(self.executed[0]["commands"], ["G28", "M104 S200"])
+
+    def test_setpoint_replaces_the_one_right_before_it(self):
+        self.assertEqual(self.run_burst(
+            {"cmd": "temperature", "heater": "tool0", "value": 200},
+            {"cmd": "temperature", "heater": "tool0", "value": 210},
+        ), [("temperature", None, [0, 1])])
+        self.assertEqual(self.executed[0]["value"], 210)
+
+    def test_setpoint_does_not_jump_over_other_commands(self):
+        self.assertEqual([msg[0] for msg in self.run_burst(
+            {"cmd": "temperature", "heater": "tool0", "value": 200},
+            {"cmd": "gcode", "commands": "M109 S200"},
+            {"cmd": "temperature", "heater": "tool0", "value": 210},
+        )], ["temperature", "gcode", "temperature"])
+
+    def test_other_commands_are_not_coalesced(self):
+        self.assertFalse(self.coalescer.submit({"cmd": "home"}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,164 @@
+from __future__ import absolute_import, unicode_literals, division, print_function
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from octoprint_mattacloud.sync import (MAX_LITERAL, Delta, OpStream,
+                                       SyncEngine, delta_body, patch,
+                                       signatures)
+
+
+def write(path, data):
+    with io.open(path, "wb") as f:
+        f.write(data)
+
+
+def read(path):
+    with io.open(path, "rb") as f:
+        return f.read()
+
+
+class DeltaTest(unittest.TestCase):
+    block_size = 2048
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.base = os.path.join(self.folder, "base.gcode")
+        self.new = os.path.join(self.folder, "new.gcode")
+        self.output = os.path.join(self.folder, "output.gcode")
+        rng = random.Random(1)
+        self.data = bytes(bytearray(rng.getrandbits(8) for _ in range(200000)))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def round_trip(self, base, new, base_exists=True):
+        if base_exists:
+            write(self.base, base)
+        write(self.new, new)
+        sums = signatures(self.base if base_exists else None, self.block_size)
+        delta = Delta(self.block_size, sums)
+        ops = delta.build(self.new)
+        body = json.loads(b"".join(
+            delta_body({"path": "new.gcode"}, self.new, ops)).decode("utf-8"))
+        received = patch(self.base if base_exists else None, self.block_size,
+                         body["ops"], self.output)
+        self.assertEqual(read(self.output), new)
+        self.assertEqual(received, delta.literal_bytes)
+        return ops, delta
+
+    def test_new_file_is_one_literal(self):
+        ops, delta = self.round_trip(b"", self.data, base_exists=False)
+        self.assertEqual(ops, [["l", 0, len(self.data)]])
+
+    def test_identical_file_only_copies(self):
+        ops, delta = self.round_trip(self.data, self.data)
+        self.assertEqual(delta.literal_bytes, 0)
+        self.assertTrue(all(op[0] == "c" for op in ops))
+
+    def test_edit_only_sends_changed_blocks(self):
+        new = (self.data[:50000] + b"G1 X10 Y10\n" + self.data[50000:120000] +
+               self.data[130000:])
+        ops, delta = self.round_trip(self.data, new)
+        self.assertLess(delta.literal_bytes, 3 * self.block_size)
+
+    def test_empty_file(self):
+        ops, delta = self.round_trip(self.data, b"")
+        self.assertEqual(ops, [])
+
+    def test_body_splits_large_literals(self):
+        data = self.data * (MAX_LITERAL * 2 // len(self.data) + 1)
+        write(self.new, data)
+        ops = Delta(self.block_size, []).build(self.new)
+        body = json.loads(b"".join(
+            delta_body({"path": "new.gcode"}, self.new, ops)).decode("utf-8"))
+        self.assertEqual(len(body["ops"]), 3)
+        self.assertEqual(body["path"], "new.gcode")
+
+    def test_patch_streams_ops_in_pieces(self):
+        new = self.data[:50000] + b"M117 changed\n" + self.data[60000:]
+        write(self.base, self.data)
+        write(self.new, new)
+        sums = signatures(self.base, self.block_size)
+        ops = Delta(self.block_size, sums).build(self.new)
+        body = b"".join(delta_body({"digest": "x"}, self.new, ops))
+        # Some encoders escape the slashes of base64.
+        body = body.replace(b"/", b"\\/")
+        chunks = [body[i:i + 7] for i in range(0, len(body), 7)]
+        patch(self.base, self.block_size, OpStream(chunks).ops(), self.output)
+        self.assertEqual(read(self.output), new)
+
+    def test_truncated_stream_is_an_error(self):
+        write(self.new, self.data)
+        ops = Delta(self.block_size, []).build(self.new)
+        body = b"".join(delta_body({}, self.new, ops))
+        with self.assertRaises(ValueError):
+            patch(None, self.block_size, OpStream([body[:-10]]).ops(),
+                  self.output)
+
+    def test_patch_needs_base_for_copies(self):
+        with self.assertRaises(ValueError):
+            patch(None, self.block_size, [["c", 0, 1]], self.output)
+
+
+class PlanTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.engine = SyncEngine(root=os.path.join(self.folder, "uploads"),
+                                 state_dir=os.path.join(self.folder, "state"),
+                                 url="http://cloud/api/sync/",
+                                 make_headers=dict, install=None, remove=None)
+        self.engine.manifest.base = {"same": "a", "local_edit": "a",
+                                     "cloud_edit": "a", "local_gone": "a",
+                                     "cloud_gone": "a", "both": "a"}
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_plan(self):
+        local = {
+            "same": {"digest": "a", "mtime": 1},
+            "local_edit": {"digest": "b", "mtime": 1},
+            "cloud_edit": {"digest": "a", "mtime": 1},
+            "cloud_gone": {"digest": "a", "mtime": 1},
+            "both": {"digest": "b", "mtime": 5},
+            "local_new": {"digest": "c", "mtime": 1},
+        }
+        cloud = {
+            "same": {"digest": "a"},
+            "local_edit": {"digest": "a"},
+            "cloud_edit": {"digest": "b"},
+            "local_gone": {"digest": "a"},
+            "both": {"digest": "c", "mtime": 9},
+            "cloud_new": {"digest": "c"},
+        }
+        actions = dict((path, (action, conflict))
+                       for action, path, conflict in
+                       self.engine.plan(local, cloud))
+        self.assertEqual(actions, {
+            "local_edit": ("upload", False),
+            "cloud_edit": ("download", False),
+            "local_gone": ("delete_remote", False),
+            "cloud_gone": ("delete_local", False),
+            "both": ("download", True),
+            "local_new": ("upload", False),
+            "cloud_new": ("download", False),
+        })
+
+    def test_newer_local_wins_a_conflict(self):
+        local = {"both": {"digest": "b", "mtime": 9}}
+        cloud = {"both": {"digest": "c", "mtime": 5}}
+        self.assertEqual(self.engine.plan(local, cloud),
+                         [("upload", "both", True)])
+
+    def test_deleted_on_both_sides_is_forgotten(self):
+        self.engine.plan({}, {})
+        self.assertNotIn("same", self.engine.manifest.base)
+
+
+if __name__ == "__main__":
+    unittest.main()